@@ -127,6 +127,64 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 
+# Recommender
+# Reviews are folded into the last trained model, a full retrain runs every N reviews
+RECOMMENDER_FULL_RETRAIN_EVERY = 50
+# Trained factors are saved here as versioned .npz files, the newest N are kept
+RECOMMENDER_MODEL_DIR = BASE_DIR / 'model_artifacts'
+RECOMMENDER_MODEL_KEEP = 5
+# Written by `manage.py tune_recommender`, picked up by every later retrain
+RECOMMENDER_TUNED_CONFIG = RECOMMENDER_MODEL_DIR / 'tuned_hyper_parameters.json'
+# ANN index of the RPyC service: number of k-means lists (None = sqrt of the catalog size)
+# and how many of them a query scans; more lists scanned = better recall, slower queries
+RECOMMENDER_ANN_LISTS = None
+RECOMMENDER_ANN_NPROBE = 8
+# Cold-start lists: movies kept per genre / age band list, and how many phantom reviews
+# at the global mean rating damp the score of rarely reviewed movies
+RECOMMENDER_POPULAR_PER_LIST = 50
+RECOMMENDER_POPULARITY_PRIOR = 5.0
+# Every retrain appends one JSON line of telemetry here (`manage.py training_runs` shows them);
+# peak memory is measured with tracemalloc, which slows training down a little
+RECOMMENDER_TELEMETRY_PATH = RECOMMENDER_MODEL_DIR / 'training_runs.jsonl'
+RECOMMENDER_TELEMETRY_TRACE_MEMORY = True
+# Full retrains are queued and run by `manage.py recalculation_worker`: a queued retrain
+# waits for N seconds without new reviews (but at most MAX_DELAY seconds), and at least
+# MIN_INTERVAL seconds pass between two retrains. Reviews arriving meanwhile share one retrain
+RECOMMENDER_RECALC_DEBOUNCE = 5.0
+RECOMMENDER_RECALC_MIN_INTERVAL = 60.0
+RECOMMENDER_RECALC_MAX_DELAY = 300.0
+# A running retrain records a heartbeat every HEARTBEAT seconds; one without a heartbeat for
+# STALE_AFTER seconds (its process died) is marked failed and queued again
+RECOMMENDER_RECALC_HEARTBEAT = 15.0
+RECOMMENDER_RECALC_STALE_AFTER = 300.0
+# A retrain pending for WORKER_TIMEOUT seconds while none runs means no worker is running:
+# it is logged, and with FALLBACK the next review runs it in its own process (so does the
+# first review of a fresh database, before anything was ever trained)
+RECOMMENDER_RECALC_WORKER_TIMEOUT = 600.0
+RECOMMENDER_RECALC_FALLBACK = True
+# The RPyC service caches the recommendations of this many users (least recently used
+# are evicted) and checks every N seconds whether a newer generation was published
+RECOMMENDER_CACHE_USERS = 10000
+RECOMMENDER_CACHE_POLL_INTERVAL = 2.0
+# Every retrain exports the published recommendations (and the factors) to a memory-mapped
+# snapshot that all RPyC service processes share; a service only serves from it while it
+# matches the current generation, so fold-ins since the export are read from the database
+RECOMMENDER_SNAPSHOT_EXPORT = True
+RECOMMENDER_SNAPSHOT_FACTORS = True
+RECOMMENDER_SNAPSHOT_PATH = RECOMMENDER_MODEL_DIR / 'recommendations.snapshot'
+# Views ask the RPyC service for recommendations through a pool of connections and read
+# the database instead while it is down; after a failure the service is retried after
+# BACKOFF seconds, doubling up to MAX_BACKOFF
+RECOMMENDER_RPC_ENABLED = True
+RECOMMENDER_RPC_HOST = 'localhost'
+RECOMMENDER_RPC_PORT = 18861
+RECOMMENDER_RPC_POOL_SIZE = 8
+RECOMMENDER_RPC_TIMEOUT = 2.0
+RECOMMENDER_RPC_CONNECT_TIMEOUT = 0.5
+RECOMMENDER_RPC_HEALTH_CHECK_INTERVAL = 30.0
+RECOMMENDER_RPC_BACKOFF = 1.0
+RECOMMENDER_RPC_MAX_BACKOFF = 60.0
+
 LOGIN_URL = 'login'
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 
@@ -9,4 +9,9 @@ admin.site.register(Genre)
 admin.site.register(Movie)
 admin.site.register(Profile)
 admin.site.register(Review)
-admin.site.register(Recommendation)
\ No newline at end of file
+admin.site.register(Recommendation)
+admin.site.register(RecommendationGeneration)
+admin.site.register(GenerationChange)
+admin.site.register(SimilarMovie)
+admin.site.register(PopularMovie)
+admin.site.register(RecalculationJob)
\ No newline at end of file
@@ -0,0 +1,77 @@
+import numpy as np
+
+from .factorization import scatter_rows, top_items
+
+
+class IVFIndex:
+    """
+    Inverted file index over item factors for approximate "top-K items for this user vector".
+
+    The items are clustered with k-means into n_lists lists. A query only scores the items of
+    the nprobe lists whose centroids have the highest inner product with the user vector,
+    so the cost is about nprobe / n_lists of a full scan. nprobe is the recall/latency knob:
+    nprobe=n_lists (or exact=True) is a brute-force scan of the whole catalog.
+    """
+
+    def __init__(self, V, n_lists=None, iterations=10, seed=0, block_size=8192):
+        self.V = np.asarray(V, dtype=np.float64)
+        num_items = len(self.V)
+        self.n_lists = max(1, min(n_lists or int(np.sqrt(num_items)), num_items))
+
+        centroids, labels = _kmeans(self.V, self.n_lists, iterations, np.random.default_rng(seed), block_size)
+        self.centroids = centroids
+
+        #The items of list l are list_items[list_offsets[l]:list_offsets[l + 1]]
+        self.list_items = np.argsort(labels, kind='stable')
+        self.list_offsets = np.zeros(self.n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=self.n_lists), out=self.list_offsets[1:])
+
+    def candidates(self, query, nprobe):
+        if nprobe >= self.n_lists:
+            return np.arange(len(self.V))
+
+        lists = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        return np.concatenate([self.list_items[self.list_offsets[l]:self.list_offsets[l + 1]] for l in lists])
+
+    def search(self, query, k, nprobe=1, exclude=(), exact=False):
+        """
+        Returns (item indices, scores) of the k best items for the query vector, best first,
+        leaving out the item indices in `exclude`.
+        """
+        query = np.asarray(query, dtype=np.float64)
+        candidates = self.candidates(query, self.n_lists if exact else max(1, nprobe))
+
+        scores = self.V[candidates] @ query
+        excluded = np.flatnonzero(np.isin(candidates, np.asarray(exclude, dtype=np.int64)))
+        best = top_items(scores, excluded, k)
+        return candidates[best], scores[best]
+
+    def recall(self, queries, k, nprobe):
+        """
+        Mean share of the exact top-k that a search with this nprobe finds, to tune nprobe.
+        """
+        found = []
+        for query in queries:
+            exact_items, _ = self.search(query, k, exact=True)
+            approximate_items, _ = self.search(query, k, nprobe=nprobe)
+            found.append(len(np.intersect1d(exact_items, approximate_items)) / max(len(exact_items), 1))
+        return float(np.mean(found)) if found else 1.0
+
+
+def _kmeans(X, n_clusters, iterations, rng, block_size):
+    centroids = X[rng.choice(len(X), n_clusters, replace=False)].copy()
+    labels = np.zeros(len(X), dtype=np.int64)
+
+    for _ in range(iterations):
+        #Squared distances without the constant ||x||^2 term, a block of rows at a time
+        squared_norms = (centroids ** 2).sum(axis=1)
+        for start in range(0, len(X), block_size):
+            block = X[start:start + block_size]
+            labels[start:start + block_size] = np.argmin(squared_norms - 2 * block @ centroids.T, axis=1)
+
+        counts = np.bincount(labels, minlength=n_clusters)
+        sums = scatter_rows(labels, X, n_clusters)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+
+    return centroids, labels
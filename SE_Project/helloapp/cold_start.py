@@ -0,0 +1,126 @@
+from collections import defaultdict
+from datetime import date
+
+from django.db.models import Avg, Case, CharField, Count, Q, Value, When
+
+from .models import PopularMovie, Review
+from .patterns import RecommendationEngine, age_on
+
+#(name, youngest age, oldest age) of the age bands popularity is computed for
+AGE_BANDS = [
+    ('under_13', 0, 12),
+    ('13_17', 13, 17),
+    ('18_24', 18, 24),
+    ('25_34', 25, 34),
+    ('35_49', 35, 49),
+    ('50_plus', 50, None),
+]
+
+
+def age_band(birthdate, today=None):
+    age = age_on(birthdate, today or date.today())
+    for name, youngest, oldest in AGE_BANDS:
+        if age >= youngest and (oldest is None or age <= oldest):
+            return name
+    return AGE_BANDS[0][0]
+
+
+def _years_before(day, years):
+    try:
+        return day.replace(year=day.year - years)
+    except ValueError:
+        #February 29th in a year that is not a leap year
+        return day.replace(year=day.year - years, day=28)
+
+
+def _birthdate_band(today):
+    """
+    A database expression giving the age band of a review's author from their birthdate.
+    """
+    whens = []
+    for name, youngest, oldest in AGE_BANDS:
+        #Born on or before this date = at least `youngest` years old today
+        born_by = _years_before(today, youngest)
+        condition = Q(user__profile__birthdate__lte=born_by)
+        if oldest is not None:
+            condition &= Q(user__profile__birthdate__gt=_years_before(today, oldest + 1))
+        whens.append(When(condition, then=Value(name)))
+    return Case(*whens, default=Value(''), output_field=CharField())
+
+
+def popularity_lists(per_list=50, prior=5.0, today=None):
+    """
+    Popularity-ranked candidate lists from Review aggregates, as
+    {(list_kind, list_key): [(movie_id, score), ...]} best first.
+
+    The score is the mean rating damped towards the global mean by `prior` phantom reviews,
+    so a single 10/10 does not beat a film hundreds of people rated 9.
+    """
+    today = today or date.today()
+    global_mean = float(Review.objects.aggregate(mean=Avg('rating'))['mean'] or 0.0)
+
+    def score(count, mean):
+        return (count * float(mean) + prior * global_mean) / (count + prior)
+
+    lists = defaultdict(list)
+
+    for row in Review.objects.values('movie_id').annotate(count=Count('id'), mean=Avg('rating')):
+        lists[(PopularMovie.ALL, '')].append((row['movie_id'], score(row['count'], row['mean'])))
+
+    genre_rows = (Review.objects.filter(movie__genres__isnull=False)
+                  .values('movie__genres', 'movie_id').annotate(count=Count('id'), mean=Avg('rating')))
+    for row in genre_rows:
+        lists[(PopularMovie.GENRE, str(row['movie__genres']))].append(
+            (row['movie_id'], score(row['count'], row['mean'])))
+
+    band_rows = (Review.objects.annotate(band=_birthdate_band(today)).exclude(band='')
+                 .values('band', 'movie_id').annotate(count=Count('id'), mean=Avg('rating')))
+    for row in band_rows:
+        lists[(PopularMovie.AGE_BAND, row['band'])].append((row['movie_id'], score(row['count'], row['mean'])))
+
+    return {key: sorted(candidates, key=lambda pair: -pair[1])[:per_list] for key, candidates in lists.items()}
+
+
+def popular_movie_rows(generation, per_list=50, prior=5.0):
+    for (list_kind, list_key), candidates in popularity_lists(per_list, prior).items():
+        for rank, (movie_id, score) in enumerate(candidates, start=1):
+            yield PopularMovie(generation=generation, list_kind=list_kind, list_key=list_key,
+                               movie_id=movie_id, rank=rank, score=score)
+
+
+def cold_start_recommendations(user, profile, genre_ids=(), n=5):
+    """
+    Merges the precomputed lists of the user's genres and age band into up to n
+    (movie, score) picks, skipping watched and unsafe movies. Movies that are on more of
+    the user's lists come first, ties are broken by the best popularity score.
+    Falls back to the overall list when the user has no genre or band list yet.
+    """
+    lists = Q(list_kind=PopularMovie.GENRE, list_key__in=[str(genre_id) for genre_id in genre_ids])
+    if profile is not None:
+        lists |= Q(list_kind=PopularMovie.AGE_BAND, list_key=age_band(profile.birthdate))
+
+    candidates = PopularMovie.objects.current().filter(lists).select_related('movie')
+    if not candidates.exists():
+        candidates = PopularMovie.objects.current().filter(list_kind=PopularMovie.ALL).select_related('movie')
+
+    watched = set(Review.objects.filter(user=user).values_list('movie_id', flat=True))
+    merged = {}
+    for candidate in candidates:
+        if candidate.movie_id in watched:
+            continue
+        hits, best, movie = merged.get(candidate.movie_id, (0, float('-inf'), candidate.movie))
+        merged[candidate.movie_id] = (hits + 1, max(best, candidate.score), movie)
+
+    ranked = sorted(merged.values(), key=lambda entry: (-entry[0], -entry[1]))
+    errors = {}
+    if profile is not None:
+        errors = RecommendationEngine().check_movies(user, [movie for _, _, movie in ranked], profile)
+
+    picks = []
+    for hits, score, movie in ranked:
+        if errors.get(movie.id):
+            continue
+        picks.append((movie, score))
+        if len(picks) == n:
+            break
+    return picks
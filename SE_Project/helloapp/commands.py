@@ -1,128 +1,318 @@
+from contextlib import contextmanager
+
 import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
 from .models import Review
-from .models import Recommendation
+from .models import PopularMovie, Recommendation, RecommendationGeneration, SimilarMovie
+from .factorization import (RatingsData, TrainedModel, build_solver, fold_in, similar_items, top_items,
+                            top_n_per_user)
+from .cold_start import popular_movie_rows
+from .model_store import ModelStore
+from .snapshot import export_snapshot
+from .telemetry import TrainingRun
+from .tuning import load_tuned_hyper_parameters
+
+#The latest trained model loaded in this process, used to fold in single users
+#and to warm-start the next retrain
+_latest_model = None
+
+
+def latest_model(store=None):
+    """
+    Returns the newest trained model, reloading it from the model store when another
+    process has saved a newer version since it was last loaded.
+    """
+    global _latest_model
+    store = store or ModelStore()
+
+    version = store.latest_version()
+    if version is not None and (_latest_model is None or _latest_model.metadata.get('version') != version):
+        _latest_model = store.load_latest() or _latest_model
+    return _latest_model
+
+
+#Largest magnitude Recommendation.predicted_rating (max_digits=5, decimal_places=2) can hold
+MAX_STORED_SCORE = 999.99
+
+
+def clean_score(raw_score):
+    """
+    Makes a predicted rating safe to store in Recommendation.predicted_rating. Scores are
+    kept as predicted, so the stored order is the predicted order; only values the column
+    cannot hold are changed.
+    """
+    raw_score = float(raw_score)
+    if np.isnan(raw_score) or np.isinf(raw_score):
+        return 0.0
+    return min(max(raw_score, -MAX_STORED_SCORE), MAX_STORED_SCORE)
+
+
+@contextmanager
+def publish_generation(model_version=None):
+    """
+    Yields a new, not yet visible RecommendationGeneration for the caller to fill. Its rows are
+    committed batch by batch, so no write transaction stays open (and locks SQLite for review
+    saves) while they are computed; readers only see the current generation meanwhile. When
+    the block exits cleanly the generation becomes the current one in one short transaction,
+    so readers switch from one complete set to the next, and older generations are deleted.
+    When it fails the new generation and its rows are deleted.
+    """
+    generation = RecommendationGeneration.objects.create(model_version=model_version)
+    try:
+        yield generation
+    except BaseException:
+        generation.delete()
+        raise
+
+    with transaction.atomic():
+        generation.publish()
+    generation.delete_older()
+
 
 class RecalculateRecommendationsCommand:
-    def __init__(self, user_ids=None, hyper_parameters=None):
+    #solver is 'als' (alternating least squares) or 'gd' (full-batch gradient descent).
+    #'reg' and 'iterations' are used by ALS, 'learning_rate' and 'epochs' by gradient descent.
+    #'holdout' is the fraction of reviews kept out of training to measure the RMSE on, which
+    #is checked every 'eval_every' epochs. Training stops after 'patience' checks in a row that
+    #improved it by less than 'tol' (relative).
+    #With 'warm_start' the factors of the last saved model are reused for known users and movies.
+    #Every user gets 'top_n' recommendations, scored 'block_size' users at a time (None sizes
+    #the blocks to factorization.BLOCK_MEMORY).
+    #Every movie gets 'similar_k' "more like this" neighbours by item factor cosine similarity.
+    #With 'workers' > 1 the ALS solves run in that many processes over shared memory;
+    #the result for a given 'seed' is the same for any number of workers
+    DEFAULT_HYPER_PARAMETERS = {
+        'solver': 'als',
+        'factors': 5,
+        'reg': 0.1,
+        'iterations': 15,
+        'learning_rate': 0.005,
+        'epochs': 5000,
+        'holdout': 0.0,
+        'eval_every': 1,
+        'tol': 1e-4,
+        'patience': 3,
+        'seed': None,
+        'workers': 1,
+        'warm_start': True,
+        'top_n': 5,
+        'block_size': None,
+        'similar_k': 10,
+    }
+    LOAD_CHUNK_SIZE = 10000
+    WRITE_BATCH_SIZE = 1000
+    #Share of the whole retrain done when each phase starts, reported to `progress`
+    PROGRESS_PHASES = {'load': 0.0, 'train': 0.1, 'save_model': 0.6, 'publish': 0.7}
+
+    def __init__(self, user_ids=None, hyper_parameters=None, progress=None):
 
         self.user_ids = user_ids or "All users"
-        self.hyper_parameters = hyper_parameters or {'epochs': 20, 'learning_rate': 0.01}
+        #The winner of the last `manage.py tune_recommender` run overrides the defaults
+        tuned = load_tuned_hyper_parameters(settings.RECOMMENDER_TUNED_CONFIG)
+        self.hyper_parameters = {**self.DEFAULT_HYPER_PARAMETERS, **tuned, **(hyper_parameters or {})}
+        self.epochs_run = 0
+        self.validation_rmse = None
+        self.telemetry = None
+        #Called as progress(phase, fraction) when a phase starts
+        self.progress = progress
+
+    def report_progress(self, phase):
+        if self.progress is not None:
+            self.progress(phase, self.PROGRESS_PHASES[phase])
 
     def execute(self):
-        user_ids = list(Review.objects.values_list('user_id', flat=True).distinct())
-        movie_ids = list(Review.objects.values_list('movie_id', flat=True).distinct())
-
-        #Create a lookup dictionary: {DatabaseID: MatrixIndex}
-        #This helps because user IDs might not start from 0 and because
-        #some users might have no reviews, so they'd be missing from the data set here
-        user_map = {id: i for i, id in enumerate(user_ids)}
-        movie_map = {id: i for i, id in enumerate(movie_ids)}
-
-        num_users = len(user_ids)
-        num_items = len(movie_ids)
-
-        #Declare a matrix of size users x movies filled with zeros
-        R = np.zeros((num_users, num_items))
-
-        for review in Review.objects.all():
-            u_idx = user_map[review.user_id]
-            m_idx = movie_map[review.movie_id]
-            R[u_idx, m_idx] = float(review.rating)
-
-        K = 5  #Number of latent features
+        with TrainingRun('retrain') as run:
+            self.telemetry = run.record
+            run.set('hyper_parameters', self.hyper_parameters)
+            self._execute(run)
+
+    def _execute(self, run):
+        self.report_progress('load')
+        with run.phase('load'):
+            #Stream plain tuples instead of building a model instance per review
+            reviews = Review.objects.values_list('user_id', 'movie_id', 'rating')
+            data = RatingsData.from_reviews(
+                reviews.iterator(chunk_size=self.LOAD_CHUNK_SIZE),
+                expected_count=reviews.count(),
+                chunk_size=self.LOAD_CHUNK_SIZE
+            )
+        num_users = data.num_users
+        num_items = data.num_items
+        run.count('reviews', data.num_ratings)
+        run.count('users', num_users)
+        run.count('movies', num_items)
+
+        K = self.hyper_parameters['factors']  #Number of latent features
         #The latent features don't actually have to be specified, they're kind of just "implied"
         #by the algorithm
-        lr = 0.005  # Learning rate
-        num_epochs = 5000
-
-        #This represents random guesses before the computer starts learning
-        U = np.random.rand(num_users, K)
-        V = np.random.rand(num_items, K)
-
-        #This basically keep track of the positions where the users already rated the movies
-        #It's needed to differentiate between an actual review and a prediction from the algorithm
-        mask = (R > 0).astype(float)
-
-        N = np.sum(mask) #number of reviews
-
-
-
-        for curr_epoch in range(num_epochs):
-            R_hat = U @ V.T
-
-            #Calculate the difference
-            #We only care about the cells where we actually have ratings
-            raw_error = R - R_hat
-            error_matrix = raw_error * mask
-
-            U_grad = -2. / N * (error_matrix) @ V
-            V_grad = -2. / N * (error_matrix).T @ U
-
-            U -= lr * U_grad
-            V -= lr * V_grad
-        final_predictions = U @ V.T
 
-        print("\n" + "=" * 50)
-        print("FINAL PREDICTED RATING MATRIX (R_hat)")
-        print("Rows = Users, Columns = Movies")
-        print("=" * 50)
+        self.report_progress('train')
+        with run.phase('train'):
+            #This represents random guesses before the computer starts learning
+            rng = np.random.default_rng(self.hyper_parameters['seed'])
+            U = rng.random((num_users, K))
+            V = rng.random((num_items, K))
+
+            store = ModelStore()
+            previous_model = latest_model(store) if self.hyper_parameters['warm_start'] else None
+            if previous_model is not None and previous_model.factors == K:
+                U, V = previous_model.warm_start(U, V, data.user_ids, data.movie_ids)
+
+            train, holdout = data, None
+            if self.hyper_parameters['holdout'] > 0:
+                train, holdout = data.split(self.hyper_parameters['holdout'], self.hyper_parameters['seed'])
+
+            #Loss and gradients are only computed over the observed ratings
+            solver = build_solver(self.hyper_parameters)
+            U, V = solver.fit(train, U, V, holdout=holdout)
+
+        self.epochs_run = solver.epochs_run
+        if holdout is not None and solver.history:
+            self.validation_rmse = min(score for _, score in solver.history)
+        run.set('epochs_run', self.epochs_run)
+        run.set('max_epochs', solver.max_epochs)
+        run.set('validation_rmse', self.validation_rmse)
+        run.set('loss_metric', 'holdout_rmse' if holdout is not None else 'train_rmse')
+        run.set('loss', [[epoch, score] for epoch, score in solver.history])
+
+        self.report_progress('save_model')
+        with run.phase('save_model'):
+            global _latest_model
+            _latest_model = TrainedModel(U, V, data.user_ids, data.movie_ids, self.hyper_parameters, metadata={
+                'trained_at': timezone.now().isoformat(),
+                'warm_started': previous_model is not None,
+                'epochs_run': self.epochs_run,
+                'validation_rmse': self.validation_rmse,
+                'num_ratings': data.num_ratings,
+            })
+            version = store.save(_latest_model)
+        run.set('model_version', version)
+
+        top_n = self.hyper_parameters['top_n']
+        block_size = self.hyper_parameters['block_size']
+        self.report_progress('publish')
+        with publish_generation(model_version=version) as generation:
+            run.set('generation', generation.id)
+
+            for first_u_idx, block_items, block_scores in run.timed(
+                    top_n_per_user(U, V, data, top_n, block_size), 'score'):
+                batch = []
+                for row, (movie_indexes, scores) in enumerate(zip(block_items, block_scores)):
+                    u_id = int(data.user_ids[first_u_idx + row])
+
+                    for m_idx, raw_score in zip(movie_indexes, scores):
+                        #-inf marks an already rated movie, the user has fewer than top_n left
+                        if raw_score == -np.inf:
+                            continue
+
+                        #Math exploded for this user, the score is stored as 0
+                        if np.isnan(raw_score) or np.isinf(raw_score):
+                            run.count('invalid_scores')
+
+                        batch.append(Recommendation(
+                            generation=generation,
+                            user_id=u_id,
+                            movie_id=int(data.movie_ids[m_idx]),
+                            predicted_rating=clean_score(raw_score)
+                        ))
+
+                with run.phase('write'):
+                    Recommendation.objects.bulk_create(batch, batch_size=self.WRITE_BATCH_SIZE)
+                run.count('recommendations', len(batch))
+
+            for first_m_idx, block_neighbours, block_similarities in run.timed(
+                    similar_items(V, self.hyper_parameters['similar_k'], block_size), 'score'):
+                batch = [
+                    SimilarMovie(
+                        generation=generation,
+                        movie_id=int(data.movie_ids[first_m_idx + row]),
+                        neighbour_id=int(data.movie_ids[n_idx]),
+                        rank=rank,
+                        similarity=float(similarity)
+                    )
+                    for row, (neighbours, similarities) in enumerate(zip(block_neighbours, block_similarities))
+                    for rank, (n_idx, similarity) in enumerate(zip(neighbours, similarities), start=1)
+                ]
+                with run.phase('write'):
+                    SimilarMovie.objects.bulk_create(batch, batch_size=self.WRITE_BATCH_SIZE)
+                run.count('similar_movies', len(batch))
+
+            #Cold-start candidate lists for users the factorization knows nothing about
+            with run.phase('popularity'):
+                batch = list(popular_movie_rows(
+                    generation,
+                    per_list=getattr(settings, 'RECOMMENDER_POPULAR_PER_LIST', 50),
+                    prior=getattr(settings, 'RECOMMENDER_POPULARITY_PRIOR', 5.0)
+                ))
+            with run.phase('write'):
+                PopularMovie.objects.bulk_create(batch, batch_size=self.WRITE_BATCH_SIZE)
+            run.count('popular_movies', len(batch))
+
+        #Service processes map the published generation from this file instead of querying it
+        if getattr(settings, 'RECOMMENDER_SNAPSHOT_EXPORT', True):
+            with run.phase('snapshot'):
+                include_factors = getattr(settings, 'RECOMMENDER_SNAPSHOT_FACTORS', True)
+                export_snapshot(model=_latest_model if include_factors else None)
+
+        print(f"Retrain finished: {self.epochs_run} of {solver.max_epochs} epochs, model version {version}, "
+              f"top {top_n} picks for {num_users} users.")
+
+
+class FoldInUserCommand:
+    """
+    Re-solves only one user's latent vector against the item factors of the last full
+    retrain and refreshes only that user's recommendations.
+    """
+
+    def __init__(self, user_id, model=None, top_n=None):
+        self.user_id = user_id
+        self.model = model
+        self.top_n = top_n
 
-        import sys
-        np.set_printoptions(threshold=sys.maxsize, precision=2, suppress=True)
-
-        print(final_predictions)
-        print("=" * 50 + "\n")
-
-        Recommendation.objects.all().delete()
-
-        #Create a reverse map so we can find the movie id from the matrix index
-        reverse_movie_map = {i: m_id for m_id, i in movie_map.items()}
-
-        for u_id, u_idx in user_map.items():
-            #Get the user's predicted ratings row
-            user_preds = final_predictions[u_idx]
-
-            unrated_movies_with_scores = []
-
-            for movie_index in range(len(R[u_idx])):
-
-                #Check the original rating in matrix R
-                actual_rating = R[u_idx][movie_index]
-
-                #If the rating is 0, it means the user hasn't seen this movie
-                if actual_rating == 0:
-                    predicted_score = user_preds[movie_index]
-                    unrated_movies_with_scores.append((movie_index, predicted_score))
-            #Helper function for sorting. Returns the second element of a tuple,
-            #in this case, the predicted rating
-            def get_score(pair):
-                return pair[1]
-
-            unrated_movies_with_scores.sort(key=get_score, reverse=True)
-
-            # Take only the first 3 movies
-            top_3_pairs = unrated_movies_with_scores[:5]
-
-            recommendations = []
-            for pair in top_3_pairs:
-                movie_index = pair[0]
-                recommendations.append(movie_index)
-
-            for m_idx in recommendations:
-                print(f"\nUser ID: {u_id}, movie ID: {reverse_movie_map[m_idx]}")
-
-                raw_score = float(user_preds[m_idx])
-
-                if np.isnan(raw_score) or np.isinf(raw_score):
-                    print(f"Warning: Math exploded for User {u_id}. setting score to 0.")
-                    clean_score = 0.0
-                else:
-                    clean_score = raw_score
-
-                Recommendation.objects.create(
-                    user_id=u_id,
-                    movie_id=reverse_movie_map[m_idx],
-                    predicted_rating=clean_score
+    def execute(self):
+        """
+        Returns False when there is no trained model to fold the user into.
+        """
+        model = self.model or latest_model()
+        if model is None:
+            return False
+
+        movie_map = model.movie_map
+        rated = [(movie_map[m_id], float(rating))
+                 for m_id, rating in Review.objects.filter(user_id=self.user_id).values_list('movie_id', 'rating')
+                 if m_id in movie_map]
+        if not rated:
+            return False
+
+        item_idx, ratings = zip(*rated)
+        reg = model.hyper_parameters.get('reg', RecalculateRecommendationsCommand.DEFAULT_HYPER_PARAMETERS['reg'])
+        user_vector = fold_in(model.V, item_idx, ratings, reg)
+        model.set_user_vector(self.user_id, user_vector)
+
+        scores = model.V @ user_vector
+        top_n = self.top_n or model.hyper_parameters.get('top_n', 5)
+        best = top_items(scores, item_idx, top_n)
+
+        with transaction.atomic():
+            #Fold-ins patch the current generation in place instead of publishing a new one
+            generation = RecommendationGeneration.current()
+            if generation is None:
+                return False
+
+            Recommendation.objects.filter(generation=generation, user_id=self.user_id).delete()
+            Recommendation.objects.bulk_create([
+                Recommendation(
+                    generation=generation,
+                    user_id=self.user_id,
+                    movie_id=int(model.movie_ids[m_idx]),
+                    predicted_rating=clean_score(scores[m_idx])
                 )
+                for m_idx in best
+            ])
+            generation.bump_revision([self.user_id])
 
-        print(f"Successfully updated Top 3 picks for {num_users} users.")
\ No newline at end of file
+        print(f"Folded in user {self.user_id}: {len(best)} recommendations refreshed.")
+        return True
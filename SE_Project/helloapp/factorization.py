@@ -0,0 +1,554 @@
+import json
+from abc import ABC, abstractmethod
+from itertools import islice
+
+import numpy as np
+
+#Bumped whenever the layout of the saved .npz model artifacts changes
+ARTIFACT_FORMAT_VERSION = 1
+#Scoring users (or items) against all items is done in row blocks: a block takes
+#BYTES_PER_SCORE per score (the float64 score and the int64 position argpartition returns),
+#and by default as many rows as fit in BLOCK_MEMORY bytes
+BYTES_PER_SCORE = 16
+BLOCK_MEMORY = 256 * 2 ** 20
+
+
+class RatingsData:
+    """
+    Observed ratings kept as COO index arrays instead of a dense users x movies matrix.
+
+    Row i of the data says that user_ids[user_idx[i]] rated movie_ids[item_idx[i]]
+    with ratings[i]. Memory is proportional to the number of reviews.
+    """
+
+    def __init__(self, user_ids, movie_ids, user_idx, item_idx, ratings):
+        self.user_ids = np.asarray(user_ids, dtype=np.int64)
+        self.movie_ids = np.asarray(movie_ids, dtype=np.int64)
+        self.user_idx = np.asarray(user_idx, dtype=np.int32)
+        self.item_idx = np.asarray(item_idx, dtype=np.int32)
+        self.ratings = np.asarray(ratings, dtype=np.float32)
+        self._by_user = None
+        self._by_item = None
+
+    @classmethod
+    def from_reviews(cls, reviews, expected_count=0, chunk_size=10000):
+        """
+        Builds the arrays in a single pass over an iterable of (user_id, movie_id, rating)
+        tuples, e.g. a streamed values_list() queryset. The arrays are preallocated for
+        expected_count rows and only grow if more arrive. The id maps are built on the way.
+        """
+        #Create a lookup dictionary: {DatabaseID: MatrixIndex}
+        #This helps because user IDs might not start from 0 and because
+        #some users might have no reviews, so they'd be missing from the data set here
+        user_map = {}
+        movie_map = {}
+        capacity = max(expected_count, 1)
+        user_idx = np.empty(capacity, dtype=np.int32)
+        item_idx = np.empty(capacity, dtype=np.int32)
+        ratings = np.empty(capacity, dtype=np.float32)
+        size = 0
+
+        reviews = iter(reviews)
+        while True:
+            chunk = list(islice(reviews, chunk_size))
+            if not chunk:
+                break
+
+            end = size + len(chunk)
+            if end > capacity:
+                capacity = max(end, capacity * 2)
+                user_idx = np.resize(user_idx, capacity)
+                item_idx = np.resize(item_idx, capacity)
+                ratings = np.resize(ratings, capacity)
+
+            user_idx[size:end] = [user_map.setdefault(user_id, len(user_map)) for user_id, _, _ in chunk]
+            item_idx[size:end] = [movie_map.setdefault(movie_id, len(movie_map)) for _, movie_id, _ in chunk]
+            ratings[size:end] = [float(rating) for _, _, rating in chunk]
+            size = end
+
+        return cls(list(user_map), list(movie_map), user_idx[:size], item_idx[:size], ratings[:size])
+
+    @property
+    def num_users(self):
+        return len(self.user_ids)
+
+    @property
+    def num_items(self):
+        return len(self.movie_ids)
+
+    @property
+    def num_ratings(self):
+        return len(self.ratings)
+
+    @property
+    def user_map(self):
+        return {int(u_id): i for i, u_id in enumerate(self.user_ids)}
+
+    @property
+    def movie_map(self):
+        return {int(m_id): i for i, m_id in enumerate(self.movie_ids)}
+
+    def by_user(self):
+        """
+        Returns the CSR view (indptr, item_idx, ratings) with the ratings grouped per user.
+        """
+        if self._by_user is None:
+            self._by_user = _compress(self.user_idx, self.item_idx, self.ratings, self.num_users)
+        return self._by_user
+
+    def by_item(self):
+        """
+        Returns the CSC view (indptr, user_idx, ratings) with the ratings grouped per movie.
+        """
+        if self._by_item is None:
+            self._by_item = _compress(self.item_idx, self.user_idx, self.ratings, self.num_items)
+        return self._by_item
+
+    def subset(self, rows):
+        """
+        Returns the given rating rows as a new RatingsData that keeps the same id maps.
+        """
+        return RatingsData(self.user_ids, self.movie_ids,
+                           self.user_idx[rows], self.item_idx[rows], self.ratings[rows])
+
+    def split(self, fraction, seed=None):
+        """
+        Randomly holds out `fraction` of the ratings. Returns (train, holdout).
+        """
+        rng = np.random.default_rng(seed)
+        is_holdout = rng.random(self.num_ratings) < fraction
+        return self.subset(~is_holdout), self.subset(is_holdout)
+
+    def rated_items(self, u_idx):
+        indptr, items, _ = self.by_user()
+        return items[indptr[u_idx]:indptr[u_idx + 1]]
+
+
+def _compress(rows, cols, values, num_rows):
+    order = np.argsort(rows, kind='stable')
+    counts = np.bincount(rows, minlength=num_rows)
+    indptr = np.zeros(num_rows + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    return indptr, cols[order], values[order]
+
+
+def scatter_rows(idx, values, num_rows):
+    """
+    Sums the rows of `values` that share the same index, like np.add.at but much faster.
+    """
+    out = np.empty((num_rows, values.shape[1]))
+    for k in range(values.shape[1]):
+        out[:, k] = np.bincount(idx, weights=values[:, k], minlength=num_rows)
+    return out
+
+
+def predict(U, V, data):
+    """
+    Predicted ratings for the observed (user, movie) pairs only.
+    """
+    return np.einsum('ij,ij->i', U[data.user_idx], V[data.item_idx])
+
+
+def rmse(U, V, data):
+    if data.num_ratings == 0:
+        return 0.0
+    error = data.ratings - predict(U, V, data)
+    return float(np.sqrt(np.mean(error ** 2)))
+
+
+class EarlyStopping:
+    """
+    Decides when training has converged from an RMSE measured every `eval_every` epochs.
+
+    An evaluation that improves the best RMSE by less than `tol` (relative) counts as stale,
+    training stops after `patience` stale evaluations in a row.
+    """
+
+    def __init__(self, eval_every=1, tol=1e-4, patience=3):
+        self.eval_every = max(1, eval_every)
+        self.tol = tol
+        self.patience = patience
+        self.best_score = None
+        self.stale_evaluations = 0
+
+    def is_due(self, epoch):
+        return epoch % self.eval_every == 0
+
+    def update(self, score):
+        """
+        Records a new score. Returns True if it is the best one seen so far.
+        """
+        if self.best_score is None:
+            self.best_score = score
+            return True
+
+        improvement = (self.best_score - score) / max(self.best_score, 1e-12)
+        if improvement < self.tol:
+            self.stale_evaluations += 1
+        else:
+            self.stale_evaluations = 0
+
+        if score < self.best_score:
+            self.best_score = score
+            return True
+        return False
+
+    def should_stop(self):
+        return self.stale_evaluations >= self.patience
+
+
+class Solver(ABC):
+    """
+    Runs step() for up to max_epochs and stops early once the monitored RMSE converges.
+
+    The RMSE is measured on the holdout ratings when they are given (and the best factors
+    are kept), otherwise on the training ratings. After fit(), epochs_run and history
+    ([(epoch, rmse), ...]) describe what actually happened.
+    """
+
+    def __init__(self, max_epochs, early_stopping=None):
+        self.max_epochs = max_epochs
+        self.early_stopping = early_stopping
+        self.epochs_run = 0
+        self.history = []
+
+    def prepare(self, data):
+        pass
+
+    @abstractmethod
+    def step(self, data, U, V):
+        pass
+
+    def fit(self, data, U, V, holdout=None):
+        self.epochs_run = 0
+        self.history = []
+        if data.num_ratings == 0:
+            return U, V
+
+        self.prepare(data)
+
+        monitor = self.early_stopping
+        evaluation_data = holdout if holdout is not None and holdout.num_ratings else data
+        keep_best = evaluation_data is not data
+        #Copies of the factors with the best holdout RMSE, None until something was evaluated
+        best = None
+
+        for epoch in range(1, self.max_epochs + 1):
+            U, V = self.step(data, U, V)
+            self.epochs_run = epoch
+
+            #The last epoch is always evaluated, so eval_every cannot skip the end of training
+            if monitor is None or not (monitor.is_due(epoch) or epoch == self.max_epochs):
+                continue
+
+            score = rmse(U, V, evaluation_data)
+            self.history.append((epoch, score))
+
+            if monitor.update(score) and keep_best:
+                best = (U.copy(), V.copy())
+            if monitor.should_stop():
+                break
+
+        if keep_best and best is not None:
+            return best
+        return U, V
+
+
+class GradientDescentSolver(Solver):
+    """
+    Full-batch gradient descent on the squared error of the observed ratings.
+    """
+
+    def __init__(self, learning_rate=0.005, epochs=5000, early_stopping=None):
+        super().__init__(epochs, early_stopping)
+        self.learning_rate = learning_rate
+
+    def step(self, data, U, V):
+        N = data.num_ratings
+        U_rows = U[data.user_idx]
+        V_rows = V[data.item_idx]
+
+        #Calculate the difference, only for the cells where we actually have ratings
+        error = data.ratings - np.einsum('ij,ij->i', U_rows, V_rows)
+
+        U_grad = -2. / N * scatter_rows(data.user_idx, error[:, None] * V_rows, data.num_users)
+        V_grad = -2. / N * scatter_rows(data.item_idx, error[:, None] * U_rows, data.num_items)
+
+        U -= self.learning_rate * U_grad
+        V -= self.learning_rate * V_grad
+        return U, V
+
+
+class AlternatingLeastSquaresSolver(Solver):
+    """
+    Alternates closed-form regularized least squares solves for all users and all movies.
+
+    Each half-step solves (Y_r^T Y_r + reg * n_r * I) x_r = Y_r^T r_r for every row r at once,
+    so it usually converges in a few dozen iterations instead of thousands of epochs.
+    """
+
+    def __init__(self, reg=0.1, iterations=15, early_stopping=None, chunk_size=65536):
+        super().__init__(iterations, early_stopping)
+        self.reg = reg
+        self.chunk_size = chunk_size
+
+    def prepare(self, data):
+        self.user_csr = data.by_user()
+        self.item_csr = data.by_item()
+
+    def step(self, data, U, V):
+        U = solve_least_squares(*self.user_csr, V, self.reg, self.chunk_size)
+        V = solve_least_squares(*self.item_csr, U, self.reg, self.chunk_size)
+        return U, V
+
+
+def solve_least_squares(indptr, cols, values, Y, reg, chunk_size=65536):
+    """
+    Solves the regularized normal equations of every row of a CSR ratings matrix against
+    the fixed factors Y. Rows are batched so that about chunk_size ratings are handled at
+    once, which bounds the memory used by the K x K outer products.
+    Rows without ratings get a zero vector.
+    """
+    num_rows = len(indptr) - 1
+    K = Y.shape[1]
+    X = np.zeros((num_rows, K))
+    counts = np.diff(indptr)
+    eye = np.eye(K)
+
+    start = 0
+    while start < num_rows:
+        stop = int(np.searchsorted(indptr, indptr[start] + chunk_size, side='right')) - 1
+        stop = min(max(stop, start + 1), num_rows)
+
+        rows = start + np.flatnonzero(counts[start:stop])
+        if len(rows):
+            lo, hi = indptr[start], indptr[stop]
+            Y_block = Y[cols[lo:hi]]
+            offsets = indptr[rows] - lo
+
+            #Every row's Gram matrix is the sum of the outer products of the factors it rated
+            A = np.add.reduceat(Y_block[:, :, None] * Y_block[:, None, :], offsets, axis=0)
+            b = np.add.reduceat(Y_block * values[lo:hi, None], offsets, axis=0)
+            A += reg * counts[rows][:, None, None] * eye
+
+            X[rows] = np.linalg.solve(A, b[..., None])[..., 0]
+        start = stop
+
+    return X
+
+
+def fold_in(V, item_idx, ratings, reg):
+    """
+    Solves a single user's latent vector against fixed item factors V.
+    """
+    indptr = np.array([0, len(item_idx)], dtype=np.int64)
+    return solve_least_squares(indptr, np.asarray(item_idx), np.asarray(ratings, dtype=np.float64), V, reg)[0]
+
+
+def top_items(scores, exclude, n):
+    """
+    Indices of the n highest scores, best first, skipping the indices in `exclude`.
+    """
+    scores = np.array(scores, dtype=np.float64)
+    scores[np.asarray(exclude, dtype=np.int64)] = -np.inf
+    n = min(n, len(scores) - len(exclude))
+    if n <= 0:
+        return np.empty(0, dtype=np.int64)
+
+    candidates = np.argpartition(-scores, n - 1)[:n]
+    return candidates[np.argsort(-scores[candidates], kind='stable')]
+
+
+def rows_per_block(num_columns, memory=BLOCK_MEMORY):
+    """
+    How many rows of num_columns scores fit in `memory` bytes, at least one.
+    """
+    return max(1, memory // max(1, num_columns * BYTES_PER_SCORE))
+
+
+def top_n_per_user(U, V, data, n, block_size=None):
+    """
+    Scores users in blocks of block_size rows and yields (first_user_idx, items, scores) per
+    block, where items[r] are the n best unrated movie indices of user first_user_idx + r,
+    best first. Users with fewer than n unrated movies get -inf scores in the leftover slots.
+
+    Peak memory is about block_size x num_items x BYTES_PER_SCORE, never the full matrix;
+    without a block_size the block is sized to fit BLOCK_MEMORY.
+    """
+    num_users, num_items = len(U), len(V)
+    n = min(n, num_items)
+    block_size = block_size or rows_per_block(num_items)
+    indptr, rated_items, _ = data.by_user()
+
+    for start in range(0, num_users, block_size):
+        stop = min(start + block_size, num_users)
+        scores = U[start:stop] @ V.T
+
+        #Already rated movies can never be recommended
+        rows = np.repeat(np.arange(stop - start), np.diff(indptr[start:stop + 1]))
+        scores[rows, rated_items[indptr[start]:indptr[stop]]] = -np.inf
+
+        if n == 0:
+            yield start, np.empty((stop - start, 0), dtype=np.int64), np.empty((stop - start, 0))
+            continue
+
+        #Partitioning the block itself, negating it first would copy it
+        candidates = np.argpartition(scores, -n, axis=1)[:, -n:]
+        candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+        order = np.argsort(-candidate_scores, axis=1, kind='stable')
+
+        yield (start,
+               np.take_along_axis(candidates, order, axis=1),
+               np.take_along_axis(candidate_scores, order, axis=1))
+
+
+def similar_items(V, k, block_size=None):
+    """
+    Cosine nearest neighbours of every item, computed block_size items at a time.
+    Yields (first_item_idx, neighbours, similarities) like top_n_per_user, with the same
+    memory bound.
+    """
+    num_items = len(V)
+    k = min(k, num_items - 1)
+    block_size = block_size or rows_per_block(num_items)
+    norms = np.linalg.norm(V, axis=1)
+    normalized = V / np.where(norms > 0, norms, 1.0)[:, None]
+
+    for start in range(0, num_items, block_size):
+        stop = min(start + block_size, num_items)
+        similarities = normalized[start:stop] @ normalized.T
+
+        #An item is not its own neighbour
+        similarities[np.arange(stop - start), np.arange(start, stop)] = -np.inf
+
+        if k <= 0:
+            yield start, np.empty((stop - start, 0), dtype=np.int64), np.empty((stop - start, 0))
+            continue
+
+        candidates = np.argpartition(similarities, -k, axis=1)[:, -k:]
+        candidate_similarities = np.take_along_axis(similarities, candidates, axis=1)
+        order = np.argsort(-candidate_similarities, axis=1, kind='stable')
+
+        yield (start,
+               np.take_along_axis(candidates, order, axis=1),
+               np.take_along_axis(candidate_similarities, order, axis=1))
+
+
+class TrainedModel:
+    """
+    The factors of a finished training run together with the database ids of their rows.
+    """
+
+    def __init__(self, U, V, user_ids, movie_ids, hyper_parameters=None, metadata=None):
+        self.U = U
+        self.V = V
+        self.user_ids = np.asarray(user_ids, dtype=np.int64)
+        self.movie_ids = np.asarray(movie_ids, dtype=np.int64)
+        self.hyper_parameters = dict(hyper_parameters or {})
+        self.metadata = dict(metadata or {})
+        self._user_map = None
+        self._movie_map = None
+
+    @property
+    def factors(self):
+        return self.V.shape[1]
+
+    def save(self, file):
+        """
+        Writes the factors, the id maps and the metadata to an .npz file (path or open file).
+        """
+        np.savez(
+            file,
+            format_version=np.array(ARTIFACT_FORMAT_VERSION),
+            U=self.U,
+            V=self.V,
+            user_ids=self.user_ids,
+            movie_ids=self.movie_ids,
+            hyper_parameters=np.array(json.dumps(self.hyper_parameters)),
+            metadata=np.array(json.dumps(self.metadata)),
+        )
+
+    @classmethod
+    def load(cls, file):
+        with np.load(file, allow_pickle=False) as artifact:
+            format_version = int(artifact['format_version'])
+            if format_version != ARTIFACT_FORMAT_VERSION:
+                raise ValueError(f"Unsupported model artifact format {format_version}, "
+                                 f"expected {ARTIFACT_FORMAT_VERSION}")
+
+            return cls(
+                artifact['U'],
+                artifact['V'],
+                artifact['user_ids'],
+                artifact['movie_ids'],
+                hyper_parameters=json.loads(str(artifact['hyper_parameters'])),
+                metadata=json.loads(str(artifact['metadata'])),
+            )
+
+    def warm_start(self, U, V, user_ids, movie_ids):
+        """
+        Copies the trained rows into the initial factors U and V of a new training run,
+        for every user and movie that this model already knows. New ones keep their values.
+        """
+        for target, source, ids, id_map in ((U, self.U, user_ids, self.user_map),
+                                             (V, self.V, movie_ids, self.movie_map)):
+            old_rows = np.array([id_map.get(int(x), -1) for x in ids], dtype=np.int64)
+            known = old_rows >= 0
+            target[known] = source[old_rows[known]]
+        return U, V
+
+    @property
+    def user_map(self):
+        if self._user_map is None:
+            self._user_map = {int(u_id): i for i, u_id in enumerate(self.user_ids)}
+        return self._user_map
+
+    @property
+    def movie_map(self):
+        if self._movie_map is None:
+            self._movie_map = {int(m_id): i for i, m_id in enumerate(self.movie_ids)}
+        return self._movie_map
+
+    def set_user_vector(self, user_id, vector):
+        """
+        Replaces the user's row of U, adding a row if the user was not part of the training.
+        """
+        u_idx = self.user_map.get(user_id)
+        if u_idx is None:
+            self.U = np.vstack([self.U, vector])
+            self.user_ids = np.append(self.user_ids, user_id)
+            self.user_map[user_id] = len(self.user_ids) - 1
+        else:
+            self.U[u_idx] = vector
+
+
+def build_solver(hyper_parameters):
+    solver = hyper_parameters['solver']
+    early_stopping = EarlyStopping(
+        eval_every=hyper_parameters['eval_every'],
+        tol=hyper_parameters['tol'],
+        patience=hyper_parameters['patience']
+    )
+
+    if solver == 'als' and hyper_parameters.get('workers', 1) > 1:
+        from .parallel import ParallelAlternatingLeastSquaresSolver
+        return ParallelAlternatingLeastSquaresSolver(
+            reg=hyper_parameters['reg'],
+            iterations=hyper_parameters['iterations'],
+            early_stopping=early_stopping,
+            workers=hyper_parameters['workers']
+        )
+    if solver == 'als':
+        return AlternatingLeastSquaresSolver(
+            reg=hyper_parameters['reg'],
+            iterations=hyper_parameters['iterations'],
+            early_stopping=early_stopping
+        )
+    if solver == 'gd':
+        return GradientDescentSolver(
+            learning_rate=hyper_parameters['learning_rate'],
+            epochs=hyper_parameters['epochs'],
+            early_stopping=early_stopping
+        )
+
+    raise ValueError(f"Unknown solver '{solver}', expected 'als' or 'gd'")
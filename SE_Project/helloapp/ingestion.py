@@ -0,0 +1,110 @@
+import threading
+
+from django.db import transaction
+
+from .commands import RecalculateRecommendationsCommand
+from .jobs import request_recalculation
+from .models import Movie, Review
+
+#Per thread: how many BulkReviewIngestion blocks are open, and whether a review was saved in one
+_deferred = threading.local()
+
+
+def recalculation_deferred():
+    """
+    True inside a BulkReviewIngestion block. The review observer then only notes that a
+    recalculation is needed instead of running one per saved review.
+    """
+    return getattr(_deferred, 'depth', 0) > 0
+
+
+def note_deferred_review():
+    _deferred.pending = True
+
+
+class BulkReviewIngestion:
+    """
+    Saves many reviews with batched bulk_create and recalculates recommendations once at the
+    end instead of once per review. Reviews the user already wrote for a movie are skipped.
+
+        with BulkReviewIngestion() as ingestion:
+            for user, movie, rating, text in rows:
+                ingestion.add(user, movie, rating, text)
+
+    retrain is 'now' (run the retrain before leaving the block), 'queue' (hand it to the
+    recalculation worker) or None (leave it to the next regular retrain).
+    """
+
+    def __init__(self, batch_size=500, retrain='now'):
+        if retrain not in ('now', 'queue', None):
+            raise ValueError(f"Unknown retrain mode: {retrain}")
+        self.batch_size = batch_size
+        self.retrain = retrain
+        self.created = 0
+        self.skipped = 0
+        self._pending = {}
+
+    def add(self, user, movie, rating, text=''):
+        """
+        Buffers one review. Returns False if one for the same user and movie is already buffered.
+        Whether it was saved is only known after the flush: see created and skipped.
+        """
+        key = (getattr(user, 'pk', user), getattr(movie, 'pk', movie))
+        if key in self._pending:
+            self.skipped += 1
+            return False
+
+        self._pending[key] = Review(user_id=key[0], movie_id=key[1], rating=rating, text=text)
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+        return True
+
+    def flush(self):
+        if not self._pending:
+            return
+
+        users = {user_id for user_id, _ in self._pending}
+        movies = {movie_id for _, movie_id in self._pending}
+        stored = Review.objects.filter(user_id__in=users, movie_id__in=movies)
+        existing = set(stored.values_list('user_id', 'movie_id'))
+        batch = [review for key, review in self._pending.items() if key not in existing]
+
+        #ignore_conflicts covers reviews written by someone else since the lookup above
+        with transaction.atomic():
+            Review.objects.bulk_create(batch, batch_size=self.batch_size, ignore_conflicts=True)
+            #It does not tell which rows it dropped; the saved ones carry the date_posted it
+            #stamped on each review
+            stamped = {(review.user_id, review.movie_id, review.date_posted) for review in batch}
+            created = len(stamped.intersection(stored.values_list('user_id', 'movie_id', 'date_posted')))
+            #bulk_create sends no post_save, so the rating aggregates are refreshed here
+            Movie.refresh_ratings(review.movie_id for review in batch)
+
+        self.created += created
+        self.skipped += len(self._pending) - created
+        self._pending = {}
+
+    def __enter__(self):
+        _deferred.depth = getattr(_deferred, 'depth', 0) + 1
+        if _deferred.depth == 1:
+            _deferred.pending = False
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            _deferred.depth -= 1
+
+        #Nested blocks leave the recalculation to the outermost one
+        if _deferred.depth > 0:
+            _deferred.pending = _deferred.pending or self.created > 0
+            return False
+
+        if (self.created or _deferred.pending) and self.retrain is not None:
+            if self.retrain == 'now':
+                RecalculateRecommendationsCommand().execute()
+            else:
+                request_recalculation(reason=f"bulk ingestion of {self.created} reviews")
+        _deferred.pending = False
+        return False
@@ -0,0 +1,233 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, connection
+from django.utils import timezone
+
+from .commands import RecalculateRecommendationsCommand
+from .models import RecalculationJob
+
+
+def request_recalculation(reason=''):
+    """
+    Queues a full retrain for the background worker and returns the (possibly shared) job.
+    """
+    job = RecalculationJob.enqueue(reason)
+    if unattended(job):
+        print(f"WARNING: recalculation #{job.id} has been waiting since {job.requested_at.isoformat()}; "
+              f"is `manage.py recalculation_worker` running?")
+    return job
+
+
+def unattended(job, now=None):
+    """
+    True if the job is pending for longer than RECOMMENDER_RECALC_WORKER_TIMEOUT seconds while
+    no retrain is running, which a recalculation worker would not have let happen.
+    """
+    now = now or timezone.now()
+    timeout = getattr(settings, 'RECOMMENDER_RECALC_WORKER_TIMEOUT', 600.0)
+    return (job.status == RecalculationJob.PENDING
+            and now - job.requested_at > timedelta(seconds=timeout)
+            and not RecalculationJob.objects.filter(status=RecalculationJob.RUNNING).exists())
+
+
+def run_unattended(job, first=False):
+    """
+    Runs the pending job in this process if no worker is going to: nothing was published yet
+    (first), so nobody gets recommendations until it ran, or it is unattended().
+    Only with RECOMMENDER_RECALC_FALLBACK. Returns the job if it ran here, else None.
+    """
+    if not getattr(settings, 'RECOMMENDER_RECALC_FALLBACK', True):
+        return None
+    if not (first or unattended(job)) or not job.claim():
+        return None
+
+    print(f"Running recalculation #{job.id} in this process, no recalculation worker picked it up.")
+    return run_job(job)
+
+
+def job_status(job_id):
+    job = RecalculationJob.objects.filter(pk=job_id).first()
+    return job.as_dict() if job is not None else None
+
+
+def wait_for_job(job_id, timeout=None, poll_interval=0.5):
+    """
+    Polls the job until it is done or failed, or until timeout seconds passed.
+    Returns its last status, None for an unknown job.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        status = job_status(job_id)
+        if status is None or status['status'] in (RecalculationJob.DONE, RecalculationJob.FAILED):
+            return status
+        if deadline is not None and time.monotonic() >= deadline:
+            return status
+        time.sleep(poll_interval if deadline is None else min(poll_interval, max(deadline - time.monotonic(), 0)))
+
+
+class Heartbeat(threading.Thread):
+    """
+    Refreshes the heartbeat of a running job every `interval` seconds until stopped, so other
+    processes can tell a long retrain from one whose process died.
+    """
+
+    def __init__(self, job, interval=None):
+        super().__init__(daemon=True, name=f'heartbeat-{job.id}')
+        self.job = job
+        self.interval = interval if interval is not None else getattr(settings, 'RECOMMENDER_RECALC_HEARTBEAT', 15.0)
+        self._stopped = threading.Event()
+
+    def run(self):
+        try:
+            while not self._stopped.wait(self.interval):
+                try:
+                    self.job.beat()
+                except DatabaseError as e:
+                    #e.g. SQLite locked by another writer; the next beat retries
+                    print(f"Could not record the heartbeat of recalculation #{self.job.id}: {e}")
+        finally:
+            connection.close()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def run_job(job, hyper_parameters=None):
+    """
+    Runs a claimed job and records its progress and how it ended.
+    """
+    def progress(phase, fraction):
+        RecalculationJob.objects.filter(pk=job.pk).update(phase=phase, progress=fraction,
+                                                          heartbeat_at=timezone.now())
+
+    command = RecalculateRecommendationsCommand(hyper_parameters=hyper_parameters, progress=progress)
+    heartbeat = Heartbeat(job)
+    heartbeat.start()
+    try:
+        command.execute()
+    except Exception as e:
+        job.status, job.error = RecalculationJob.FAILED, f"{type(e).__name__}: {e}"
+    else:
+        job.status, job.phase, job.progress = RecalculationJob.DONE, 'done', 1.0
+    finally:
+        heartbeat.stop()
+        job.finished_at = timezone.now()
+        if command.telemetry:
+            job.telemetry_run_id = command.telemetry['run_id']
+        job.save(update_fields=['status', 'error', 'finished_at', 'telemetry_run_id', 'phase', 'progress'])
+    return job
+
+
+class BackgroundRecalculations:
+    """
+    Runs retrains requested through trigger() on a single background thread of this process,
+    so the caller gets a job id back at once.
+
+    Triggers collapse into the job in flight: while a retrain is running or queued (by this
+    process, the review observer or another one) trigger() returns that job instead of
+    starting another retrain.
+
+    With enqueue_only the job is only queued and left to `manage.py recalculation_worker`,
+    for processes that may exit before a retrain finishes (e.g. forked per connection).
+    """
+
+    def __init__(self, on_finished=None, poll_interval=0.5, enqueue_only=False):
+        self.on_finished = on_finished
+        self.poll_interval = poll_interval
+        self.enqueue_only = enqueue_only
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='recalculation')
+        self._lock = threading.Lock()
+
+    def trigger(self, reason=''):
+        with self._lock:
+            job = RecalculationJob.in_flight()
+            if job is not None and job.status == RecalculationJob.RUNNING:
+                return job
+
+            job = request_recalculation(reason)
+            if not self.enqueue_only:
+                self._executor.submit(self._run, job.id)
+            return job
+
+    def _run(self, job_id):
+        close_old_connections()
+        try:
+            #A retrain started elsewhere finishes first, or is failed once its heartbeat stops;
+            #the queued job then runs right after it
+            while RecalculationJob.objects.filter(status=RecalculationJob.RUNNING).exists():
+                time.sleep(self.poll_interval)
+                RecalculationJob.fail_stale()
+
+            job = RecalculationJob.objects.get(pk=job_id)
+            #The recalculation worker may have claimed it meanwhile
+            if not job.claim():
+                return
+
+            print(f"Running recalculation #{job.id} ({job.trigger_count} triggers: {job.reason})")
+            run_job(job)
+            if self.on_finished is not None:
+                self.on_finished(job)
+        finally:
+            close_old_connections()
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+class RecalculationWorker:
+    """
+    Runs queued retrains one at a time.
+
+    A pending job waits until no new trigger arrived for `debounce` seconds (but never longer
+    than `max_delay` after it was first requested), and until `min_interval` seconds passed
+    since the previous retrain finished. Triggers arriving meanwhile are merged into it.
+    """
+
+    def __init__(self, debounce=None, min_interval=None, max_delay=None, poll_interval=1.0):
+        self.debounce = debounce if debounce is not None else getattr(settings, 'RECOMMENDER_RECALC_DEBOUNCE', 5.0)
+        self.min_interval = (min_interval if min_interval is not None
+                             else getattr(settings, 'RECOMMENDER_RECALC_MIN_INTERVAL', 60.0))
+        self.max_delay = max_delay if max_delay is not None else getattr(settings, 'RECOMMENDER_RECALC_MAX_DELAY', 300.0)
+        self.poll_interval = poll_interval
+
+    def due_job(self, now=None):
+        now = now or timezone.now()
+        #A retrain abandoned by a dead process would otherwise block the queue forever
+        RecalculationJob.fail_stale(now=now)
+
+        last_finished = (RecalculationJob.objects.filter(finished_at__isnull=False)
+                         .order_by('-finished_at').values_list('finished_at', flat=True).first())
+        if last_finished is not None and now - last_finished < timedelta(seconds=self.min_interval):
+            return None
+        if RecalculationJob.objects.filter(status=RecalculationJob.RUNNING).exists():
+            return None
+
+        job = RecalculationJob.objects.filter(status=RecalculationJob.PENDING).order_by('id').first()
+        if job is None:
+            return None
+
+        quiet = now - job.last_triggered_at >= timedelta(seconds=self.debounce)
+        overdue = now - job.requested_at >= timedelta(seconds=self.max_delay)
+        return job if quiet or overdue else None
+
+    def run_once(self):
+        """
+        Runs the next job if one is due. Returns it, or None when nothing ran.
+        """
+        job = self.due_job()
+        if job is None or not job.claim():
+            return None
+
+        print(f"Running recalculation #{job.id} ({job.trigger_count} triggers: {job.reason})")
+        return run_job(job)
+
+    def run_forever(self):
+        while True:
+            close_old_connections()
+            if self.run_once() is None:
+                time.sleep(self.poll_interval)
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from helloapp.commands import latest_model
+from helloapp.snapshot import export_snapshot, snapshot_path
+
+
+class Command(BaseCommand):
+    help = 'Export the current recommendation generation to the memory-mapped snapshot file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default=None, help='Snapshot file (default: RECOMMENDER_SNAPSHOT_PATH)')
+        parser.add_argument('--no-factors', action='store_true', help='Leave the latent factors out')
+
+    def handle(self, *args, **options):
+        path = options['path'] or snapshot_path()
+        token = export_snapshot(path, model=None if options['no_factors'] else latest_model())
+        if token is None:
+            self.stdout.write(self.style.ERROR("No recommendation generation has been published yet."))
+            return
+        self.stdout.write(self.style.SUCCESS(f"Exported generation {token[0]} (revision {token[1]}) to {path}"))
@@ -3,12 +3,19 @@ from datetime import date
 from django.core.management.base import BaseCommand
 from django.contrib.auth import get_user_model
 # === CHANGE 'api' TO YOUR ACTUAL APP NAME ===
-from helloapp.models import Movie, Review, Genre
+from helloapp.models import Movie, Genre
+from helloapp.ingestion import BulkReviewIngestion
 
 
 class Command(BaseCommand):
     help = 'Populate database with Movies and Reviews'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--retrain', choices=['now', 'queue', 'none'], default='now',
+                            help='Retrain recommendations once at the end, queue the retrain for the '
+                                 'recalculation worker, or skip it')
+        parser.add_argument('--batch-size', type=int, default=500)
+
     def handle(self, *args, **kwargs):
         User = get_user_model()
         users = list(User.objects.all())
@@ -45,6 +52,17 @@ class Command(BaseCommand):
 
         self.stdout.write("Starting population...")
 
+        # Reviews are saved in batches and recommendations are recalculated once at the end,
+        # not once per review
+        retrain = None if kwargs['retrain'] == 'none' else kwargs['retrain']
+        ingestion = BulkReviewIngestion(batch_size=kwargs['batch_size'], retrain=retrain)
+        with ingestion:
+            self.populate(users, movies_data, review_comments, ingestion)
+
+        self.stdout.write(f"Added {ingestion.created} reviews, skipped {ingestion.skipped} duplicates.")
+        self.stdout.write(self.style.SUCCESS("DONE! Data population complete."))
+
+    def populate(self, users, movies_data, review_comments, ingestion):
         for m_name, m_date_str, m_dur, m_dir, m_studio, m_genre_names in movies_data:
             y, m, d = map(int, m_date_str.split('-'))
             release_date_obj = date(y, m, d)
@@ -77,21 +95,18 @@ class Command(BaseCommand):
                 for _ in range(number_of_reviews):
                     selected_user = random.choice(users)
 
-                    # USE get_or_create TO AVOID CRASHING ON DUPLICATES
-                    review, review_created = Review.objects.get_or_create(
-                        user=selected_user,
-                        movie=movie,
-                        defaults={
-                            'rating': round(random.uniform(4.0, 10.0), 1),
-                            'text': random.choice(review_comments)
-                        }
+                    # Duplicates (same user twice, or an existing review) are skipped by the ingestion;
+                    # reviews are saved in batches, the totals are reported after the last one
+                    review_added = ingestion.add(
+                        selected_user,
+                        movie,
+                        rating=round(random.uniform(4.0, 10.0), 1),
+                        text=random.choice(review_comments)
                     )
 
-                    if review_created:
-                        self.stdout.write(f"   -> Added review by {selected_user.username}")
+                    if review_added:
+                        self.stdout.write(f"   -> Queued review by {selected_user.username}")
                     else:
                         self.stdout.write(f"   -> Skipped review (User {selected_user.username} already reviewed this)")
             else:
-                self.stdout.write(f"   -> Skipped {m_name} (already exists)")
-
-        self.stdout.write(self.style.SUCCESS("DONE! Data population complete."))
\ No newline at end of file
+                self.stdout.write(f"   -> Skipped {m_name} (already exists)")
\ No newline at end of file
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from helloapp.jobs import RecalculationWorker
+
+
+class Command(BaseCommand):
+    help = 'Run queued recommendation recalculations in the background'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--debounce', type=float, default=None,
+                            help='Seconds without new triggers before a pending job runs')
+        parser.add_argument('--min-interval', type=float, default=None,
+                            help='Minimum seconds between the end of one retrain and the start of the next')
+        parser.add_argument('--max-delay', type=float, default=None,
+                            help='A pending job runs at the latest this many seconds after it was requested')
+        parser.add_argument('--poll', type=float, default=1.0, help='Seconds between queue checks')
+        parser.add_argument('--once', action='store_true', help='Run at most one due job and exit')
+
+    def handle(self, *args, **options):
+        worker = RecalculationWorker(
+            debounce=options['debounce'],
+            min_interval=options['min_interval'],
+            max_delay=options['max_delay'],
+            poll_interval=options['poll']
+        )
+
+        if options['once']:
+            job = worker.run_once()
+            if job is None:
+                self.stdout.write("No recalculation due.")
+            else:
+                self.stdout.write(f"Recalculation #{job.id} finished: {job.status}")
+            return
+
+        self.stdout.write(f"Recalculation worker started (debounce {worker.debounce}s, "
+                          f"min interval {worker.min_interval}s, max delay {worker.max_delay}s).")
+        worker.run_forever()
@@ -0,0 +1,46 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from helloapp.telemetry import recent_runs
+
+
+class Command(BaseCommand):
+    help = 'Show the telemetry of the last recommender retrains'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--last', type=int, default=10, help='How many runs to show')
+        parser.add_argument('--kind', default=None, help='Only runs of this kind, e.g. retrain')
+        parser.add_argument('--json', action='store_true', help='Print the raw JSON records')
+
+    def handle(self, *args, **options):
+        runs = recent_runs(options['last'], kind=options['kind'])
+        if not runs:
+            self.stdout.write("No training runs recorded yet.")
+            return
+
+        for run in runs:
+            if options['json']:
+                self.stdout.write(json.dumps(run))
+                continue
+
+            phases = "  ".join(f"{name}={seconds:.3f}s" for name, seconds in run.get('phases', {}).items())
+            counts = "  ".join(f"{name}={value}" for name, value in run.get('counts', {}).items())
+            peak = run.get('peak_memory_bytes')
+            loss = run.get('loss') or []
+
+            status = run.get('status')
+            style = self.style.SUCCESS if status == 'ok' else self.style.ERROR
+            self.stdout.write(style(
+                f"{run.get('started_at')}  {run.get('kind')}  {status}  {run.get('seconds', 0):.3f}s  "
+                f"model v{run.get('model_version')}  epochs {run.get('epochs_run')}/{run.get('max_epochs')}"
+            ))
+            self.stdout.write(f"    phases: {phases}")
+            self.stdout.write(f"    counts: {counts}")
+            if loss:
+                self.stdout.write(f"    {run.get('loss_metric')}: {loss[0][1]:.4f} -> {loss[-1][1]:.4f} "
+                                  f"over {len(loss)} evaluations")
+            if peak is not None:
+                self.stdout.write(f"    peak memory: {peak / 1024 / 1024:.1f} MiB")
+            if run.get('error'):
+                self.stdout.write(f"    error: {run['error']}")
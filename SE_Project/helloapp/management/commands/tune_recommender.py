@@ -0,0 +1,93 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from helloapp.commands import RecalculateRecommendationsCommand
+from helloapp.factorization import RatingsData
+from helloapp.models import Review
+from helloapp.tuning import candidate_configs, search, save_tuned_hyper_parameters
+
+
+def _values(cast):
+    def parse(text):
+        return [cast(value) for value in text.split(',') if value]
+    return parse
+
+
+class Command(BaseCommand):
+    help = 'Cross-validate recommender hyper_parameters and save the best ones for the trainer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--solver', type=_values(str), default=['als'])
+        parser.add_argument('--factors', type=_values(int), default=[5, 10, 20])
+        parser.add_argument('--reg', type=_values(float), default=[0.01, 0.05, 0.1, 0.5])
+        parser.add_argument('--iterations', type=_values(int), default=[15])
+        parser.add_argument('--learning-rate', type=_values(float), default=[0.005])
+        parser.add_argument('--epochs', type=_values(int), default=[5000])
+        parser.add_argument('--samples', type=int, default=None,
+                            help='Try this many random configs from the grid instead of all of them')
+        parser.add_argument('--folds', type=int, default=5)
+        parser.add_argument('--workers', type=int, default=1)
+        parser.add_argument('--top-k', type=int, default=5, help='k of precision@k')
+        parser.add_argument('--relevant-rating', type=float, default=7.0,
+                            help='Test ratings from this value up count as hits for precision@k')
+        parser.add_argument('--metric', choices=['rmse', 'precision'], default='rmse')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--dry-run', action='store_true', help='Report only, do not save the winner')
+
+    def handle(self, *args, **options):
+        if options['folds'] < 2:
+            raise CommandError("--folds must be at least 2")
+
+        data = RatingsData.from_reviews(
+            Review.objects.values_list('user_id', 'movie_id', 'rating').iterator(chunk_size=10000),
+            expected_count=Review.objects.count()
+        )
+        if data.num_ratings < options['folds']:
+            raise CommandError(f"Only {data.num_ratings} reviews, not enough for {options['folds']} folds")
+
+        base = {**RecalculateRecommendationsCommand.DEFAULT_HYPER_PARAMETERS, 'seed': options['seed'], 'workers': 1}
+        grid = {
+            'solver': options['solver'],
+            'factors': options['factors'],
+            'reg': options['reg'],
+            'iterations': options['iterations'],
+            'learning_rate': options['learning_rate'],
+            'epochs': options['epochs'],
+        }
+        configs = candidate_configs(base, grid, options['samples'], options['seed'])
+
+        self.stdout.write(f"Cross-validating {len(configs)} configs on {data.num_ratings} reviews "
+                          f"({options['folds']} folds, {options['workers']} workers)...")
+
+        results = []
+        for result in search(data, configs, options['folds'], options['workers'],
+                             options['top_k'], options['relevant_rating'], options['seed']):
+            results.append(result)
+            hp = result['hyper_parameters']
+            self.stdout.write(
+                f"  {hp['solver']:>3} factors={hp['factors']:<3} reg={hp['reg']:<6} "
+                f"iterations={hp['iterations']:<4} lr={hp['learning_rate']:<7} epochs={hp['epochs']:<6} "
+                f"RMSE={result['rmse']:.4f}  precision@{options['top_k']}={result['precision_at_k']:.3f}  "
+                f"{result['seconds']:.2f}s"
+            )
+
+        if options['metric'] == 'rmse':
+            best = min(results, key=lambda result: result['rmse'])
+        else:
+            best = max(results, key=lambda result: result['precision_at_k'])
+
+        tuned = {name: best['hyper_parameters'][name] for name in grid}
+        self.stdout.write(self.style.SUCCESS(
+            f"Best by {options['metric']}: {tuned} "
+            f"(RMSE {best['rmse']:.4f}, precision@{options['top_k']} {best['precision_at_k']:.3f})"
+        ))
+
+        if not options['dry_run']:
+            save_tuned_hyper_parameters(settings.RECOMMENDER_TUNED_CONFIG, tuned, {
+                'rmse': best['rmse'],
+                'precision_at_k': best['precision_at_k'],
+                'seconds': best['seconds'],
+                'folds': options['folds'],
+                'top_k': options['top_k'],
+            })
+            self.stdout.write(f"Saved to {settings.RECOMMENDER_TUNED_CONFIG}")
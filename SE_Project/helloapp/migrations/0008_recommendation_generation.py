@@ -0,0 +1,49 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:04
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def adopt_existing_recommendations(apps, schema_editor):
+    # Rows written before generations existed become the first current generation
+    Recommendation = apps.get_model('helloapp', 'Recommendation')
+    RecommendationGeneration = apps.get_model('helloapp', 'RecommendationGeneration')
+
+    if Recommendation.objects.filter(generation__isnull=True).exists():
+        generation = RecommendationGeneration.objects.create(is_current=True)
+        Recommendation.objects.filter(generation__isnull=True).update(generation=generation)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('helloapp', '0007_recommendation'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecommendationGeneration',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('is_current', models.BooleanField(db_index=True, default=False)),
+                ('model_version', models.IntegerField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='recommendation',
+            unique_together=set(),
+        ),
+        migrations.AddField(
+            model_name='recommendation',
+            name='generation',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='recommendations', to='helloapp.recommendationgeneration'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='recommendation',
+            unique_together={('generation', 'user', 'movie')},
+        ),
+        migrations.RunPython(adopt_existing_recommendations, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:09
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('helloapp', '0009_similarmovie'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PopularMovie',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('list_kind', models.CharField(choices=[('all', 'All reviews'), ('genre', 'Genre'), ('age', 'Age band')], max_length=10)),
+                ('list_key', models.CharField(blank=True, max_length=50)),
+                ('rank', models.PositiveSmallIntegerField()),
+                ('score', models.FloatField()),
+                ('generation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='popular_movies', to='helloapp.recommendationgeneration')),
+                ('movie', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='helloapp.movie')),
+            ],
+            options={
+                'unique_together': {('generation', 'list_kind', 'list_key', 'rank')},
+            },
+        ),
+    ]
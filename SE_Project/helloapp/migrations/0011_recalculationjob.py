@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:12
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('helloapp', '0010_popularmovie'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecalculationJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], db_index=True, default='pending', max_length=10)),
+                ('reason', models.CharField(blank=True, max_length=200)),
+                ('trigger_count', models.PositiveIntegerField(default=1)),
+                ('requested_at', models.DateTimeField(auto_now_add=True)),
+                ('last_triggered_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('error', models.TextField(blank=True)),
+                ('telemetry_run_id', models.CharField(blank=True, max_length=32)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('helloapp', '0011_recalculationjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recommendationgeneration',
+            name='revision',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
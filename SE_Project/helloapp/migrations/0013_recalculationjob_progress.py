@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('helloapp', '0012_recommendationgeneration_revision'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recalculationjob',
+            name='phase',
+            field=models.CharField(blank=True, max_length=20),
+        ),
+        migrations.AddField(
+            model_name='recalculationjob',
+            name='progress',
+            field=models.FloatField(default=0.0),
+        ),
+    ]
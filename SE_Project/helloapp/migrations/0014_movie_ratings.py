@@ -0,0 +1,47 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:21
+
+from django.db import migrations, models
+from django.db.models import Avg, Count
+
+
+def compute_movie_ratings(apps, schema_editor):
+    # Movies reviewed before the aggregates existed
+    Movie = apps.get_model('helloapp', 'Movie')
+    Review = apps.get_model('helloapp', 'Review')
+
+    stats = Review.objects.values('movie_id').annotate(avg=Avg('rating'), count=Count('id'))
+    for row in stats:
+        Movie.objects.filter(id=row['movie_id']).update(rating_avg=float(row['avg']), rating_count=row['count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('helloapp', '0013_recalculationjob_progress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='movie',
+            name='rating_avg',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.AddField(
+            model_name='movie',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='movie',
+            index=models.Index(fields=['name', 'id'], name='helloapp_mo_name_616577_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='movie',
+            index=models.Index(fields=['releaseDate', 'id'], name='helloapp_mo_release_aa24cd_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='movie',
+            index=models.Index(fields=['rating_avg', 'id'], name='helloapp_mo_rating__7b91a1_idx'),
+        ),
+        migrations.RunPython(compute_movie_ratings, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('helloapp', '0014_movie_ratings'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='recommendation',
+            name='predicted_rating',
+            field=models.DecimalField(decimal_places=2, max_digits=5),
+        ),
+    ]
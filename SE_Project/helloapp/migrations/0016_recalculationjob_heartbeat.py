@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('helloapp', '0015_widen_predicted_rating'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recalculationjob',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='recalculationjob',
+            name='owner_pid',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,94 @@
+import os
+import re
+import tempfile
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from .factorization import TrainedModel
+
+_ARTIFACT_NAME = re.compile(r'^model_v(\d+)\.npz$')
+_LATEST_POINTER = 'LATEST'
+
+
+@contextmanager
+def atomic_write(path, mode):
+    """
+    Writes to a temporary file next to path and renames it into place when the block exits
+    cleanly, so readers see either the old or the complete new file.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(str(path)) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as file:
+            yield file
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+class ModelStore:
+    """
+    Versioned on-disk storage of trained models, shared by every process on the machine.
+
+    Each save writes model_v<version>.npz next to a LATEST file naming the newest one.
+    Both are written to a temporary file first and renamed into place, so a reader never
+    sees a half written artifact.
+    """
+
+    def __init__(self, directory=None, keep=None):
+        self.directory = str(directory or settings.RECOMMENDER_MODEL_DIR)
+        self.keep = keep if keep is not None else getattr(settings, 'RECOMMENDER_MODEL_KEEP', 5)
+
+    def versions(self):
+        if not os.path.isdir(self.directory):
+            return []
+        found = (_ARTIFACT_NAME.match(name) for name in os.listdir(self.directory))
+        return sorted(int(match.group(1)) for match in found if match)
+
+    def path_for(self, version):
+        return os.path.join(self.directory, f"model_v{version:06d}.npz")
+
+    def latest_version(self):
+        try:
+            with open(os.path.join(self.directory, _LATEST_POINTER)) as pointer:
+                return int(pointer.read().strip())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save(self, model):
+        """
+        Stores the model as a new version and returns that version number.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        versions = self.versions()
+        version = (versions[-1] if versions else 0) + 1
+        model.metadata['version'] = version
+
+        with atomic_write(self.path_for(version), 'wb') as artifact:
+            model.save(artifact)
+        with atomic_write(os.path.join(self.directory, _LATEST_POINTER), 'w') as pointer:
+            pointer.write(str(version))
+
+        for old_version in versions[:max(0, len(versions) + 1 - self.keep)]:
+            try:
+                os.remove(self.path_for(old_version))
+            except FileNotFoundError:
+                pass
+
+        return version
+
+    def load(self, version):
+        return TrainedModel.load(self.path_for(version))
+
+    def load_latest(self):
+        """
+        Returns the newest model, or None when nothing was trained yet.
+        """
+        version = self.latest_version()
+        if version is None:
+            return None
+        try:
+            return self.load(version)
+        except FileNotFoundError:
+            return None
@@ -1,6 +1,9 @@
+import os
 import uuid
+from datetime import timedelta
 
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
 from django.utils import timezone
 
 # Create your models here.
@@ -38,6 +41,34 @@ class Movie(models.Model):
     duration_minutes = models.IntegerField(default=0)
     director = models.CharField(max_length=200)
     studio = models.CharField(max_length=200)
+    #Average and number of review ratings, kept up to date by refresh_ratings() so the
+    #library can sort and paginate by rating through an index
+    rating_avg = models.FloatField(default=0.0)
+    rating_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        #Keyset pagination of the library walks one of these, the id breaks ties
+        indexes = [
+            models.Index(fields=['name', 'id']),
+            models.Index(fields=['releaseDate', 'id']),
+            models.Index(fields=['rating_avg', 'id']),
+        ]
+
+    @classmethod
+    def refresh_ratings(cls, movie_ids):
+        """
+        Recomputes rating_avg and rating_count of the given movies from their reviews.
+        """
+        movie_ids = set(movie_ids)
+        stats = {movie_id: (float(avg), count) for movie_id, avg, count in
+                 Review.objects.filter(movie_id__in=movie_ids).values('movie_id')
+                 .annotate(avg=models.Avg('rating'), count=models.Count('id'))
+                 .values_list('movie_id', 'avg', 'count')}
+
+        movies = list(cls.objects.filter(id__in=movie_ids).only('id'))
+        for movie in movies:
+            movie.rating_avg, movie.rating_count = stats.get(movie.id, (0.0, 0))
+        cls.objects.bulk_update(movies, ['rating_avg', 'rating_count'], batch_size=500)
 
     def __str__(self):
         return self.name
@@ -65,13 +96,291 @@ class LoginAttempt(models.Model):
     def is_valid(self):
         return (timezone.now() - self.created_at).total_seconds() < 300
 
+class RecommendationGeneration(models.Model):
+    """
+    One complete set of recommendations written by a retrain.
+    Readers only ever see the rows of the generation flagged as current.
+    """
+    created_at = models.DateTimeField(auto_now_add=True)
+    is_current = models.BooleanField(default=False, db_index=True)
+    model_version = models.IntegerField(null=True, blank=True)
+    #Bumped whenever rows of the generation are changed in place (fold-ins), so caches
+    #can tell that (id, revision) no longer matches what they hold
+    revision = models.PositiveIntegerField(default=0)
+
+    @classmethod
+    def current(cls):
+        return cls.objects.filter(is_current=True).order_by('-id').first()
+
+    @classmethod
+    def current_token(cls):
+        """
+        (id, revision) of the current generation, or None before the first retrain.
+        """
+        return cls.objects.filter(is_current=True).order_by('-id').values_list('id', 'revision').first()
+
+    @classmethod
+    def changed_users(cls, generation_id, after_revision, up_to_revision=None):
+        """
+        Ids of the users whose rows of the generation were changed in place by the revisions
+        after after_revision (up to up_to_revision).
+        """
+        changes = GenerationChange.objects.filter(generation_id=generation_id, revision__gt=after_revision)
+        if up_to_revision is not None:
+            changes = changes.filter(revision__lte=up_to_revision)
+        return set(changes.values_list('user_id', flat=True))
+
+    def bump_revision(self, user_ids=()):
+        """
+        Starts a new revision after the rows of these users were changed in place, and records
+        which users it changed. Call it inside the transaction that changed them.
+        """
+        RecommendationGeneration.objects.filter(pk=self.pk).update(revision=models.F('revision') + 1)
+        self.revision = RecommendationGeneration.objects.values_list('revision', flat=True).get(pk=self.pk)
+        GenerationChange.objects.bulk_create([
+            GenerationChange(generation=self, revision=self.revision, user_id=user_id) for user_id in user_ids
+        ])
+
+    def publish(self):
+        """
+        Makes this generation the current one, once all its rows are written. Call it inside a
+        transaction, so readers never see no current generation.
+        """
+        RecommendationGeneration.objects.filter(is_current=True).exclude(pk=self.pk).update(is_current=False)
+        self.is_current = True
+        self.save(update_fields=['is_current'])
+
+    def delete_older(self):
+        """
+        Removes the generations published before this one, together with their rows.
+        """
+        return RecommendationGeneration.objects.filter(id__lt=self.id, is_current=False).delete()
+
+    def __str__(self):
+        return f"Generation {self.id}{' (current)' if self.is_current else ''}"
+
+
+class GenerationChange(models.Model):
+    """
+    A user whose recommendations a revision of a generation changed, so caches and snapshots
+    of an older revision only have to drop that user instead of everything.
+    """
+    generation = models.ForeignKey(RecommendationGeneration, on_delete=models.CASCADE, related_name='changes')
+    revision = models.PositiveIntegerField()
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+
+    class Meta:
+        indexes = [models.Index(fields=['generation', 'revision'])]
+
+
+class GenerationQuerySet(models.QuerySet):
+    """
+    Rows written by a retrain for one RecommendationGeneration.
+    """
+
+    def current(self):
+        return self.filter(generation__is_current=True)
+
+
 class Recommendation(models.Model):
+    generation = models.ForeignKey(RecommendationGeneration, on_delete=models.CASCADE, null=True,
+                                   related_name='recommendations')
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     movie = models.ForeignKey(Movie, on_delete=models.CASCADE)
-    predicted_rating = models.DecimalField(max_digits=3, decimal_places=2)
+    predicted_rating = models.DecimalField(max_digits=5, decimal_places=2)
+
+    objects = GenerationQuerySet.as_manager()
 
     class Meta:
-        unique_together = ('user', 'movie')
+        unique_together = ('generation', 'user', 'movie')
+
+    def __str__(self):
+        return f"Rec for {self.user.username}: {self.movie.name} ({self.predicted_rating})"
+
+
+class SimilarMovie(models.Model):
+    """
+    The rank-th nearest neighbour of a movie by item factor cosine similarity,
+    precomputed by a retrain and published with its RecommendationGeneration.
+    """
+    generation = models.ForeignKey(RecommendationGeneration, on_delete=models.CASCADE,
+                                   related_name='similar_movies')
+    movie = models.ForeignKey(Movie, on_delete=models.CASCADE, related_name='+')
+    neighbour = models.ForeignKey(Movie, on_delete=models.CASCADE, related_name='+')
+    rank = models.PositiveSmallIntegerField()
+    similarity = models.FloatField()
+
+    objects = GenerationQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ('generation', 'movie', 'rank')
+
+    def __str__(self):
+        return f"{self.movie.name} -> {self.neighbour.name} (#{self.rank})"
+
+
+class PopularMovie(models.Model):
+    """
+    The rank-th most popular movie of a cold-start candidate list: all reviews, the reviews of
+    one genre's movies (list_key = genre id) or the reviews of one age band (list_key = band).
+    """
+    ALL = 'all'
+    GENRE = 'genre'
+    AGE_BAND = 'age'
+    LIST_KINDS = [(ALL, 'All reviews'), (GENRE, 'Genre'), (AGE_BAND, 'Age band')]
+
+    generation = models.ForeignKey(RecommendationGeneration, on_delete=models.CASCADE,
+                                   related_name='popular_movies')
+    list_kind = models.CharField(max_length=10, choices=LIST_KINDS)
+    list_key = models.CharField(max_length=50, blank=True)
+    movie = models.ForeignKey(Movie, on_delete=models.CASCADE, related_name='+')
+    rank = models.PositiveSmallIntegerField()
+    score = models.FloatField()
+
+    objects = GenerationQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ('generation', 'list_kind', 'list_key', 'rank')
+
+    def __str__(self):
+        return f"{self.list_kind} {self.list_key} #{self.rank}: {self.movie.name}"
+
+
+class RecalculationJob(models.Model):
+    """
+    A queued full recommendation retrain. Triggers arriving while a job is still pending
+    are merged into it, a background worker runs it.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = [(PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    status = models.CharField(max_length=10, choices=STATUSES, default=PENDING, db_index=True)
+    reason = models.CharField(max_length=200, blank=True)
+    trigger_count = models.PositiveIntegerField(default=1)
+    requested_at = models.DateTimeField(auto_now_add=True)
+    last_triggered_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    telemetry_run_id = models.CharField(max_length=32, blank=True)
+    #Set by the retrain while it runs
+    phase = models.CharField(max_length=20, blank=True)
+    progress = models.FloatField(default=0.0)
+    #Refreshed by the process running the job; a running job whose heartbeat stopped was abandoned
+    owner_pid = models.PositiveIntegerField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+
+    @classmethod
+    def fail_stale(cls, stale_after=None, now=None):
+        """
+        Marks running jobs without a heartbeat for stale_after seconds as failed, and queues
+        a new job in place of each, so a retrain whose process died is run again.
+        Returns the failed jobs.
+        """
+        if stale_after is None:
+            stale_after = getattr(settings, 'RECOMMENDER_RECALC_STALE_AFTER', 300.0)
+        now = now or timezone.now()
+        cutoff = now - timedelta(seconds=stale_after)
+
+        #Jobs claimed before heartbeats were recorded only have started_at
+        silent = models.Q(heartbeat_at__lt=cutoff) | models.Q(heartbeat_at__isnull=True, started_at__lt=cutoff)
+
+        stale = []
+        for job in cls.objects.filter(silent, status=cls.RUNNING):
+            #Only one caller fails the job, so it is re-queued once
+            last_seen = job.heartbeat_at or job.started_at
+            failed = cls.objects.filter(silent, pk=job.pk, status=cls.RUNNING).update(
+                status=cls.FAILED, finished_at=now,
+                error=f"No heartbeat from process {job.owner_pid} since {last_seen.isoformat()}")
+            if failed:
+                print(f"Recalculation #{job.id} was abandoned by process {job.owner_pid}, queueing it again.")
+                cls.enqueue(f"retry of #{job.id}: {job.reason}"[:200])
+                stale.append(job)
+        return stale
+
+    @classmethod
+    def in_flight(cls):
+        """
+        The running job, or else the oldest pending one, or None.
+        """
+        cls.fail_stale()
+        running = cls.objects.filter(status=cls.RUNNING).order_by('id').first()
+        return running or cls.objects.filter(status=cls.PENDING).order_by('id').first()
+
+    @classmethod
+    def enqueue(cls, reason=''):
+        """
+        Returns the pending job, after merging this trigger into it, or a new one.
+        """
+        with transaction.atomic():
+            job = cls.objects.select_for_update().filter(status=cls.PENDING).order_by('id').first()
+            if job is None:
+                return cls.objects.create(reason=reason)
+
+            cls.objects.filter(pk=job.pk).update(
+                trigger_count=models.F('trigger_count') + 1,
+                last_triggered_at=timezone.now()
+            )
+            job.refresh_from_db()
+            return job
+
+    def claim(self):
+        """
+        Marks the job as running. Returns False if another worker got to it first.
+        """
+        now = timezone.now()
+        pid = os.getpid()
+        claimed = RecalculationJob.objects.filter(pk=self.pk, status=self.PENDING).update(
+            status=self.RUNNING, started_at=now, heartbeat_at=now, owner_pid=pid)
+        if claimed:
+            self.status, self.started_at, self.heartbeat_at, self.owner_pid = self.RUNNING, now, now, pid
+        return bool(claimed)
+
+    def beat(self):
+        """
+        Records that the job's process is still working on it.
+        """
+        self.heartbeat_at = timezone.now()
+        RecalculationJob.objects.filter(pk=self.pk, status=self.RUNNING).update(heartbeat_at=self.heartbeat_at)
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'reason': self.reason,
+            'trigger_count': self.trigger_count,
+            'requested_at': self.requested_at.isoformat() if self.requested_at else None,
+            'last_triggered_at': self.last_triggered_at.isoformat() if self.last_triggered_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'error': self.error,
+            'phase': self.phase,
+            'progress': self.progress,
+            'owner_pid': self.owner_pid,
+            'heartbeat_at': self.heartbeat_at.isoformat() if self.heartbeat_at else None,
+            'queued_seconds': self.queued_seconds(),
+            'seconds': self.seconds(),
+        }
+
+    def queued_seconds(self):
+        if self.started_at is None:
+            return None
+        return (self.started_at - self.requested_at).total_seconds()
+
+    def seconds(self):
+        """
+        How long the retrain ran, or has been running so far.
+        """
+        if self.started_at is None:
+            return None
+        return ((self.finished_at or timezone.now()) - self.started_at).total_seconds()
+
+    @property
+    def finished(self):
+        return self.status in (self.DONE, self.FAILED)
 
     def __str__(self):
-        return f"Rec for {self.user.username}: {self.movie.name} ({self.predicted_rating})"
\ No newline at end of file
+        return f"Recalculation #{self.id} ({self.status}, {self.trigger_count} triggers)"
\ No newline at end of file
@@ -0,0 +1,54 @@
+import base64
+import json
+
+from django.db.models import Q
+
+
+def encode_cursor(value, pk):
+    """
+    Opaque token for the position after the row with this sort value and primary key.
+    """
+    raw = json.dumps([value.isoformat() if hasattr(value, 'isoformat') else value, pk])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(model, field, cursor):
+    """
+    (sort value, primary key) from a cursor of encode_cursor, or None if it is not valid.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        value, pk = json.loads(raw)
+        return model._meta.get_field(field).to_python(value), int(pk)
+    except Exception:
+        return None
+
+
+def keyset_page(queryset, field, descending=False, cursor=None, size=24):
+    """
+    One page of queryset ordered by (field, id), starting after the cursor position.
+
+    Unlike an OFFSET, the cursor is a WHERE on an index of (field, id), so every page costs
+    the same no matter how deep it is. Returns (rows, cursor of the next page or None).
+    """
+    if descending:
+        queryset = queryset.order_by(f'-{field}', '-id')
+    else:
+        queryset = queryset.order_by(field, 'id')
+
+    position = decode_cursor(queryset.model, field, cursor) if cursor else None
+    if position is not None:
+        value, pk = position
+        #field <= value AND (field < value OR id < pk), so the index range scan starts at value
+        if descending:
+            queryset = queryset.filter(**{f'{field}__lte': value}).filter(
+                Q(**{f'{field}__lt': value}) | Q(id__lt=pk))
+        else:
+            queryset = queryset.filter(**{f'{field}__gte': value}).filter(
+                Q(**{f'{field}__gt': value}) | Q(id__gt=pk))
+
+    rows = list(queryset[:size + 1])
+    if len(rows) <= size:
+        return rows, None
+    rows = rows[:size]
+    return rows, encode_cursor(getattr(rows[-1], field), rows[-1].id)
@@ -0,0 +1,135 @@
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .factorization import AlternatingLeastSquaresSolver, solve_least_squares
+
+#Arrays attached by a pool worker, filled in by _attach_worker
+_worker_arrays = {}
+
+
+class SharedArrays:
+    """
+    Copies NumPy arrays into multiprocessing.shared_memory blocks so that pool workers can
+    read and write them in place, without pickling them for every task.
+    """
+
+    def __init__(self, arrays):
+        self.blocks = {}
+        self.arrays = {}
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            shared = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+            shared[...] = array
+            self.blocks[name] = block
+            self.arrays[name] = shared
+
+    def handles(self):
+        """
+        What a worker needs to attach the same blocks: {name: (block name, shape, dtype)}.
+        """
+        return {name: (self.blocks[name].name, array.shape, array.dtype.str)
+                for name, array in self.arrays.items()}
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def close(self):
+        self.arrays = {}
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+def _attach_worker(handles):
+    for name, (block_name, shape, dtype) in handles.items():
+        #Spawned workers share the parent's resource tracker, so the parent's unlink()
+        #is the only cleanup the block gets
+        block = shared_memory.SharedMemory(name=block_name)
+        _worker_arrays[name] = (block, np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf))
+
+
+def _solve_rows(side, start, stop, reg, chunk_size):
+    arrays = {name: array for name, (_, array) in _worker_arrays.items()}
+    if side == 'user':
+        X, Y = arrays['U'], arrays['V']
+    else:
+        X, Y = arrays['V'], arrays['U']
+
+    indptr = arrays[f'{side}_indptr'][start:stop + 1]
+    X[start:stop] = solve_least_squares(indptr, arrays[f'{side}_cols'], arrays[f'{side}_values'],
+                                        Y, reg, chunk_size)
+
+
+def partition_rows(indptr, parts):
+    """
+    Splits the rows of a CSR matrix into at most `parts` contiguous ranges holding about the
+    same number of ratings each.
+    """
+    num_rows = len(indptr) - 1
+    targets = np.linspace(0, indptr[-1], parts + 1)[1:-1]
+    bounds = np.unique(np.concatenate([[0], np.searchsorted(indptr, targets), [num_rows]]))
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+
+class ParallelAlternatingLeastSquaresSolver(AlternatingLeastSquaresSolver):
+    """
+    ALS whose per-user and per-movie solves are spread over a pool of worker processes.
+
+    The ratings and both factor matrices live in shared memory. Every half-step only sends
+    the workers row ranges and each worker writes its solved rows in place. Every row is
+    solved exactly as in the serial solver, so results do not depend on the worker count.
+    """
+
+    def __init__(self, reg=0.1, iterations=15, early_stopping=None, workers=2, chunk_size=65536):
+        super().__init__(reg, iterations, early_stopping, chunk_size)
+        self.workers = workers
+
+    def fit(self, data, U, V, holdout=None):
+        if data.num_ratings == 0:
+            return U, V
+
+        user_indptr, user_cols, user_values = data.by_user()
+        item_indptr, item_cols, item_values = data.by_item()
+
+        with SharedArrays({
+            'U': np.asarray(U, dtype=np.float64),
+            'V': np.asarray(V, dtype=np.float64),
+            'user_indptr': user_indptr, 'user_cols': user_cols, 'user_values': user_values,
+            'item_indptr': item_indptr, 'item_cols': item_cols, 'item_values': item_values,
+        }) as shared:
+            self.ranges = {
+                'user': partition_rows(user_indptr, self.workers * 4),
+                'item': partition_rows(item_indptr, self.workers * 4),
+            }
+
+            context = multiprocessing.get_context('spawn')
+            with context.Pool(self.workers, initializer=_attach_worker, initargs=(shared.handles(),)) as pool:
+                self.pool = pool
+                U, V = super().fit(data, shared['U'], shared['V'], holdout)
+                #The shared blocks are released on exit, hand back private copies
+                U, V = U.copy(), V.copy()
+
+            self.pool = None
+
+        return U, V
+
+    def prepare(self, data):
+        pass
+
+    def step(self, data, U, V):
+        for side in ('user', 'item'):
+            self.pool.starmap(_solve_rows, [
+                (side, start, stop, self.reg, self.chunk_size) for start, stop in self.ranges[side]
+            ])
+        return U, V
@@ -2,34 +2,63 @@ from abc import ABC, abstractmethod
 from datetime import date
 import subprocess
 import os
+from django.db.models import prefetch_related_objects
 from .models import Review
 
 
+def age_on(birthdate, today):
+    return today.year - birthdate.year - ((today.month, today.day) < (birthdate.month, birthdate.day))
+
+
+class CheckContext:
+    """
+    What the visitors need to know about a user and a batch of movies, loaded with a fixed
+    number of queries: the user's age, the movies they reviewed and the genre names per movie.
+    Genres already prefetched on the movies are used as they are.
+    """
+
+    def __init__(self, user, movies, profile):
+        self.age = age_on(profile.birthdate, date.today())
+        self.watched = set(Review.objects.filter(user=user).values_list('movie_id', flat=True))
+
+        prefetch_related_objects(movies, 'genres')
+        self.genres = {movie.id: [g.name for g in movie.genres.all()] for movie in movies}
+
+
 class Visitor(ABC):
 
     @abstractmethod
-    def visit(self, user, movie, profile):
+    def visit(self, user, movie, profile, context=None):
         pass
 
 
 class AgeSafetyVisitor(Visitor):
-    def visit(self, user, movie, profile):
-        today = date.today()
-        age = today.year - profile.birthdate.year - (
-                    (today.month, today.day) < (profile.birthdate.month, profile.birthdate.day))
+    #Movies of these genres are blocked for users younger than MINIMUM_AGE
+    RESTRICTED_GENRES = ("Horror", "Thriller")
+    MINIMUM_AGE = 18
+
+    def visit(self, user, movie, profile, context=None):
+        if context is not None:
+            age = context.age
+            genres = context.genres[movie.id]
+        else:
+            age = age_on(profile.birthdate, date.today())
+            genres = [g.name for g in movie.genres.all()]
 
-        genres = [g.name for g in movie.genres.all()]
-        is_horror = "Horror" in genres or "Thriller" in genres
+        is_horror = any(genre in genres for genre in self.RESTRICTED_GENRES)
 
-        if is_horror and age < 18:
-            return f"Blocked: Age Safety Violation! (User is {age}, needs 18 for Horror)"
+        if is_horror and age < self.MINIMUM_AGE:
+            return f"Blocked: Age Safety Violation! (User is {age}, needs {self.MINIMUM_AGE} for Horror)"
 
         return "Safe"
 
 
 class WatchHistoryVisitor(Visitor):
-    def visit(self, user, movie, profile):
-        already_watched = Review.objects.filter(user=user, movie=movie).exists()
+    def visit(self, user, movie, profile, context=None):
+        if context is not None:
+            already_watched = movie.id in context.watched
+        else:
+            already_watched = Review.objects.filter(user=user, movie=movie).exists()
 
         if already_watched:
             return f"Blocked: Watched Movie Violation! (You have already seen '{movie.name}')"
@@ -48,16 +77,25 @@ class RecommendationEngine:
             WatchHistoryVisitor()
         ]
 
-    def check_movie(self, user, movie, profile):
+    def check_movie(self, user, movie, profile, context=None):
         errors = []
         for visitor in self.visitors:
-            result = visitor.visit(user, movie, profile)
+            result = visitor.visit(user, movie, profile, context)
 
             if "Blocked" in result:
                 errors.append(result)
 
         return errors
 
+    def check_movies(self, user, movies, profile):
+        """
+        Checks many movies at once against one prefetched CheckContext.
+        Returns {movie id: errors}.
+        """
+        movies = list(movies)
+        context = CheckContext(user, movies, profile)
+        return {movie.id: self.check_movie(user, movie, profile, context) for movie in movies}
+
 
 class KFrameworkBridge:
     """
@@ -65,9 +103,7 @@ class KFrameworkBridge:
     """
 
     def check_movie(self, user, movie, profile):
-        today = date.today()
-        age = today.year - profile.birthdate.year - (
-                    (today.month, today.day) < (profile.birthdate.month, profile.birthdate.day))
+        age = age_on(profile.birthdate, date.today())
 
         genres_list = [g.name for g in movie.genres.all()]
         k_genre = "Other"
@@ -0,0 +1,169 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import rpyc
+from django.conf import settings
+
+from .serving import stored_recommendations
+
+
+class RecommendationServiceUnavailable(Exception):
+    pass
+
+
+class RecommendationClient:
+    """
+    Thread-safe pool of connections to the RPyC recommendation service.
+
+    Connections are reused across calls and checked with a ping when they were idle for
+    longer than health_check_interval. Every call is bounded by `timeout` seconds. After a
+    failure the service is considered down and calls fail at once with
+    RecommendationServiceUnavailable until a backoff (doubling up to max_backoff) has passed.
+    """
+
+    def __init__(self, host=None, port=None, pool_size=None, timeout=None, connect_timeout=None,
+                 health_check_interval=None, backoff=None, max_backoff=None):
+        self.host = host or getattr(settings, 'RECOMMENDER_RPC_HOST', 'localhost')
+        self.port = port or getattr(settings, 'RECOMMENDER_RPC_PORT', 18861)
+        self.pool_size = pool_size or getattr(settings, 'RECOMMENDER_RPC_POOL_SIZE', 8)
+        self.timeout = timeout or getattr(settings, 'RECOMMENDER_RPC_TIMEOUT', 2.0)
+        self.connect_timeout = connect_timeout or getattr(settings, 'RECOMMENDER_RPC_CONNECT_TIMEOUT', 0.5)
+        self.health_check_interval = (health_check_interval if health_check_interval is not None
+                                      else getattr(settings, 'RECOMMENDER_RPC_HEALTH_CHECK_INTERVAL', 30.0))
+        self.backoff = backoff or getattr(settings, 'RECOMMENDER_RPC_BACKOFF', 1.0)
+        self.max_backoff = max_backoff or getattr(settings, 'RECOMMENDER_RPC_MAX_BACKOFF', 60.0)
+
+        #Idle connections as (connection, last used), the most recently used last
+        self._idle = []
+        self._slots = threading.BoundedSemaphore(self.pool_size)
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._retry_at = 0.0
+
+    def _connect(self):
+        stream = rpyc.SocketStream.connect(self.host, self.port, timeout=self.connect_timeout)
+        return rpyc.connect_stream(stream, config={'sync_request_timeout': self.timeout})
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn, last_used = self._idle.pop()
+
+            if conn.closed:
+                continue
+            if time.monotonic() - last_used < self.health_check_interval:
+                return conn
+            try:
+                conn.ping(timeout=self.timeout)
+                return conn
+            except (OSError, EOFError):
+                self._discard(conn)
+
+        return self._connect()
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _failed(self, error):
+        with self._lock:
+            self._failures += 1
+            delay = min(self.backoff * 2 ** (self._failures - 1), self.max_backoff)
+            self._retry_at = time.monotonic() + delay
+            #The other idle connections most likely broke too
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._discard(conn)
+        print(f"Recommendation service at {self.host}:{self.port} failed ({error}), retrying in {delay:.1f}s")
+
+    @property
+    def available(self):
+        """
+        False while backing off after a failure.
+        """
+        return time.monotonic() >= self._retry_at
+
+    @contextmanager
+    def connection(self):
+        if not self.available:
+            raise RecommendationServiceUnavailable(f"Backing off until the service at {self.host}:{self.port} "
+                                                   f"recovers")
+        if not self._slots.acquire(timeout=self.timeout):
+            raise RecommendationServiceUnavailable("No free connection in the pool")
+
+        conn = None
+        try:
+            conn = self._checkout()
+            yield conn
+        except (OSError, EOFError) as e:
+            if conn is not None:
+                self._discard(conn)
+            self._failed(f"{type(e).__name__}: {e}")
+            raise RecommendationServiceUnavailable(f"{type(e).__name__}: {e}") from e
+        except BaseException:
+            #After any other error the state of the connection is unknown, it is not reused
+            if conn is not None:
+                self._discard(conn)
+            raise
+        else:
+            with self._lock:
+                self._failures = 0
+                self._idle.append((conn, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    def call(self, name, *args, **kwargs):
+        """
+        Calls the exposed method `name` of the service.
+        """
+        with self.connection() as conn:
+            return getattr(conn.root, name)(*args, **kwargs)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._discard(conn)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    The RecommendationClient shared by every thread of this process.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = RecommendationClient()
+    return _client
+
+
+def recommendations_for(user_id):
+    """
+    ((movie_id, name, score), ...) of the user, best first: from the recommendation service,
+    or straight from the database when the service is disabled, down or the call failed.
+    """
+    if getattr(settings, 'RECOMMENDER_RPC_ENABLED', True):
+        try:
+            for served_user_id, recs in get_client().call('get_recommendations_many', (int(user_id),)):
+                if served_user_id == user_id:
+                    return tuple((movie_id, name, score) for movie_id, name, score in recs)
+            return ()
+        except RecommendationServiceUnavailable:
+            pass
+        except Exception as e:
+            #An error raised by the service (e.g. its database is locked) must not fail the page;
+            #rpyc appends the remote traceback to the message, only its first line is logged
+            message = str(e).split('\n', 1)[0]
+            print(f"Recommendation service call failed, reading from the database: {type(e).__name__}: {message}")
+
+    return stored_recommendations(user_id)
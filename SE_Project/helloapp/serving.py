@@ -0,0 +1,374 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+
+import numpy as np
+from django.conf import settings
+
+from .ann import IVFIndex
+from .factorization import fold_in, top_items
+from .model_store import ModelStore
+from .models import Genre, Movie, Profile, Recommendation, RecommendationGeneration, Review
+from .patterns import AgeSafetyVisitor, age_on
+
+#One stored recommendation in the packed payload of get_recommendations_many
+RECOMMENDATION_RECORD = np.dtype([('user_id', '<i8'), ('movie_id', '<i8'), ('score', '<f4')])
+#SQLite limits the number of query parameters, larger batches are split
+USER_BATCH_SIZE = 500
+
+
+class Catalog:
+    """
+    Per-movie data aligned with the item factors of a model, for filtering scores with
+    array operations: movie names, which movies still exist, a movie x genre membership
+    matrix and which movies the age safety rule restricts.
+    """
+
+    def __init__(self, movie_ids):
+        movie_map = {int(m_id): m_idx for m_idx, m_id in enumerate(movie_ids)}
+        num_items = len(movie_ids)
+
+        self.names = [''] * num_items
+        self.present = np.zeros(num_items, dtype=bool)
+        for m_id, name in Movie.objects.filter(id__in=list(movie_map)).values_list('id', 'name'):
+            self.names[movie_map[m_id]] = name
+            self.present[movie_map[m_id]] = True
+
+        genres = list(Genre.objects.values_list('id', 'name'))
+        self.genre_columns = {g_id: column for column, (g_id, _) in enumerate(genres)}
+        self.genre_names = {name.lower(): g_id for g_id, name in genres}
+
+        self.genres = np.zeros((num_items, len(genres)), dtype=bool)
+        links = Movie.genres.through.objects.filter(movie_id__in=list(movie_map)).values_list('movie_id', 'genre_id')
+        for m_id, g_id in links:
+            self.genres[movie_map[m_id], self.genre_columns[g_id]] = True
+
+        restricted = [self.genre_columns[g_id] for g_id, name in genres
+                      if name in AgeSafetyVisitor.RESTRICTED_GENRES]
+        self.restricted = self.genres[:, restricted].any(axis=1)
+
+    def genre_mask(self, genres):
+        """
+        Movies having any of the genres, given by id or (case-insensitive) name.
+        """
+        columns = []
+        for genre in genres:
+            g_id = self.genre_names.get(genre.lower()) if isinstance(genre, str) else int(genre)
+            if g_id in self.genre_columns:
+                columns.append(self.genre_columns[g_id])
+        return self.genres[:, columns].any(axis=1)
+
+
+class ServingState:
+    """
+    A loaded model with the ANN index and the catalog built for it. Never changed after it
+    is built, so a reader holding one always sees the three of the same version.
+    """
+
+    def __init__(self, model, index, catalog, version):
+        self.model = model
+        self.index = index
+        self.catalog = catalog
+        self.version = version
+
+
+class ServedModel:
+    """
+    The latest trained model from the ModelStore plus an ANN index over its item factors,
+    shared by every connection of a service process. It reloads itself when a newer model
+    version has been saved.
+
+    A reload builds a new ServingState and swaps it in with one assignment, so requests
+    scoring meanwhile keep using the state they started with.
+    """
+
+    def __init__(self, store=None, n_lists=None):
+        self.store = store or ModelStore()
+        self.n_lists = n_lists or getattr(settings, 'RECOMMENDER_ANN_LISTS', None)
+        self.state = None
+        self._lock = threading.Lock()
+
+    @property
+    def version(self):
+        state = self.state
+        return state.version if state is not None else None
+
+    def refresh(self):
+        """
+        Loads the newest model if it is not the one being served. Returns the state to serve
+        from, or None if no model was trained yet.
+        """
+        version = self.store.latest_version()
+        if version is not None and version != self.version:
+            with self._lock:
+                if version != self.version:
+                    model = self.store.load_latest()
+                    if model is not None and len(model.movie_ids):
+                        index = IVFIndex(model.V, n_lists=self.n_lists)
+                        catalog = Catalog(model.movie_ids)
+                        self.state = ServingState(model, index, catalog, model.metadata.get('version', version))
+                        print(f"Serving model version {self.state.version} "
+                              f"({len(model.movie_ids)} movies in {index.n_lists} lists).")
+        return self.state
+
+    @staticmethod
+    def reviewed(model, user_id):
+        """
+        (movie indexes, ratings) of the user's reviews of movies the model knows.
+        """
+        movie_map = model.movie_map
+        reviewed = [(movie_map[m_id], float(rating))
+                    for m_id, rating in Review.objects.filter(user_id=user_id).values_list('movie_id', 'rating')
+                    if m_id in movie_map]
+        rated_idx = np.array([m_idx for m_idx, _ in reviewed], dtype=np.int64)
+        ratings = np.array([rating for _, rating in reviewed])
+        return rated_idx, ratings
+
+    @staticmethod
+    def user_vector(model, rated_idx, ratings):
+        """
+        The user's vector folded in from their current ratings, or None without any. The
+        trained row is not used: it misses every review since the model was trained.
+        """
+        if not len(rated_idx):
+            return None
+        return fold_in(model.V, rated_idx, ratings, model.hyper_parameters.get('reg', 0.1))
+
+    def recommend(self, user_id, n=10, genres=(), exclude_reviewed=True, age_safe=True):
+        """
+        The n best movies for the user as ((movie_id, name, score), ...), best first, scored
+        against every movie of the catalog. genres keeps only movies of any of those genres.
+        age_safe applies the AgeSafetyVisitor rule; users without a profile count as minors.
+        """
+        state = self.refresh()
+        if state is None:
+            return ()
+
+        model, catalog = state.model, state.catalog
+        rated_idx, ratings = self.reviewed(model, user_id)
+        vector = self.user_vector(model, rated_idx, ratings)
+        if vector is None:
+            return ()
+
+        allowed = catalog.present.copy()
+        if exclude_reviewed:
+            allowed[rated_idx] = False
+        if genres:
+            allowed &= catalog.genre_mask(genres)
+        if age_safe:
+            birthdate = Profile.objects.filter(user_id=user_id).values_list('birthdate', flat=True).first()
+            if birthdate is None or age_on(birthdate, date.today()) < AgeSafetyVisitor.MINIMUM_AGE:
+                allowed &= ~catalog.restricted
+
+        scores = model.V @ vector
+        scores[~allowed] = -np.inf
+        best = top_items(scores, (), n)
+        return tuple((int(model.movie_ids[m_idx]), catalog.names[m_idx], float(scores[m_idx]))
+                     for m_idx in best if scores[m_idx] != -np.inf)
+
+    def top_k(self, user_id, k, nprobe=None, exact=False):
+        """
+        The k best unreviewed movies for the user as ((movie_id, score), ...), best first.
+        """
+        state = self.refresh()
+        if state is None:
+            return ()
+
+        model, index = state.model, state.index
+        rated_idx, ratings = self.reviewed(model, user_id)
+        vector = self.user_vector(model, rated_idx, ratings)
+        if vector is None:
+            return ()
+
+        nprobe = nprobe or getattr(settings, 'RECOMMENDER_ANN_NPROBE', 8)
+        items, scores = index.search(vector, k, nprobe=nprobe, exclude=rated_idx, exact=exact)
+        return tuple((int(model.movie_ids[m_idx]), float(score)) for m_idx, score in zip(items, scores))
+
+
+def recommendations_many(user_ids):
+    """
+    The stored recommendations of the current generation for many users, best first per user,
+    as (user_id, movie_id, movie name, score) rows ordered by user.
+    """
+    user_ids = sorted({int(user_id) for user_id in user_ids})
+    rows = []
+    for start in range(0, len(user_ids), USER_BATCH_SIZE):
+        rows.extend(
+            Recommendation.objects.current()
+            .filter(user_id__in=user_ids[start:start + USER_BATCH_SIZE])
+            .order_by('user_id', '-predicted_rating', 'movie_id')
+            .values_list('user_id', 'movie_id', 'movie__name', 'predicted_rating')
+        )
+    return [(user_id, movie_id, name, float(score)) for user_id, movie_id, name, score in rows]
+
+
+def pack_recommendations(rows):
+    """
+    Packs (user_id, movie_id, name, score) rows into bytes of RECOMMENDATION_RECORD records.
+    """
+    records = np.empty(len(rows), dtype=RECOMMENDATION_RECORD)
+    for i, (user_id, movie_id, _, score) in enumerate(rows):
+        records[i] = (user_id, movie_id, score)
+    return records.tobytes()
+
+
+def unpack_recommendations(blob):
+    """
+    The structured array of RECOMMENDATION_RECORD records in a packed payload.
+    """
+    return np.frombuffer(blob, dtype=RECOMMENDATION_RECORD)
+
+
+class RecommendationCache:
+    """
+    Bounded LRU cache of the stored recommendations per user, shared by every connection of
+    a service process.
+
+    The whole cache is dropped when a new RecommendationGeneration is published; when fold-ins
+    changed the current one in place only the users they changed are dropped. Other processes
+    (the web app, the recalculation worker) publish too, so the generation is looked up in the
+    database at most every poll_interval seconds. invalidate() drops everything at once.
+    """
+
+    def __init__(self, max_users=None, poll_interval=None):
+        self.max_users = max_users or getattr(settings, 'RECOMMENDER_CACHE_USERS', 10000)
+        if poll_interval is None:
+            poll_interval = getattr(settings, 'RECOMMENDER_CACHE_POLL_INTERVAL', 2.0)
+        self.poll_interval = poll_interval
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.user_invalidations = 0
+        #Bumped by every invalidation; a load only lands in the cache if it did not change meanwhile
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._token = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def token(self):
+        """
+        (id, revision) of the current generation as of the last check.
+        """
+        return self._token
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self.generation += 1
+            self.invalidations += 1
+            self._checked_at = None
+
+    def invalidate_users(self, user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                if self._entries.pop(user_id, None) is not None:
+                    self.user_invalidations += 1
+            self.generation += 1
+
+    def check_generation(self):
+        """
+        Brings the cache up to the current generation in the database: drops the users that
+        fold-ins changed since the cached revision, or everything for another generation.
+        """
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.poll_interval:
+            return
+
+        token = RecommendationGeneration.current_token()
+        if token != self._token:
+            if token is not None and self._token is not None and token[0] == self._token[0] and token[1] > self._token[1]:
+                self.invalidate_users(RecommendationGeneration.changed_users(token[0], self._token[1], token[1]))
+            else:
+                self.invalidate()
+        self._token, self._checked_at = token, now
+
+    def get(self, user_id, load):
+        """
+        The cached value for the user, or load(user_id) which is then cached.
+        """
+        self.check_generation()
+
+        with self._lock:
+            if user_id in self._entries:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return self._entries[user_id]
+            self.misses += 1
+            generation = self.generation
+
+        value = load(user_id)
+
+        with self._lock:
+            if generation == self.generation:
+                self._store(user_id, value)
+        return value
+
+    def get_many(self, user_ids, load_many):
+        """
+        {user_id: value} for the users: the cached ones, and the others from a single
+        load_many(missing user ids) call returning {user_id: value}, which are then cached.
+        """
+        self.check_generation()
+
+        found, missing = {}, []
+        with self._lock:
+            for user_id in user_ids:
+                if user_id in self._entries:
+                    self._entries.move_to_end(user_id)
+                    found[user_id] = self._entries[user_id]
+                else:
+                    missing.append(user_id)
+            self.hits += len(found)
+            self.misses += len(missing)
+            generation = self.generation
+
+        if missing:
+            loaded = load_many(missing)
+            with self._lock:
+                if generation == self.generation:
+                    for user_id in missing:
+                        self._store(user_id, loaded[user_id])
+            found.update(loaded)
+        return found
+
+    def _store(self, user_id, value):
+        #Called with the lock held
+        self._entries[user_id] = value
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'users': len(self._entries),
+                'max_users': self.max_users,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'user_invalidations': self.user_invalidations,
+                'generation': self.generation,
+            }
+
+
+def stored_recommendations(user_id):
+    """
+    ((movie_id, name, score), ...) of the user from the current generation, best first.
+    """
+    return stored_recommendations_many([user_id])[user_id]
+
+
+def stored_recommendations_many(user_ids):
+    """
+    {user_id: ((movie_id, name, score), ...)} with every one of the users, best first.
+    """
+    by_user = {user_id: [] for user_id in user_ids}
+    for user_id, movie_id, name, score in recommendations_many(user_ids):
+        by_user[user_id].append((movie_id, name, score))
+    return {user_id: tuple(recs) for user_id, recs in by_user.items()}
\ No newline at end of file
@@ -1,16 +1,85 @@
-from django.db.models.signals import post_save
+import threading
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
-from .models import Review
-from .commands import RecalculateRecommendationsCommand
+from .models import Movie, RecommendationGeneration, Review
+from .commands import FoldInUserCommand
+from .jobs import request_recalculation, run_unattended
+from .ingestion import note_deferred_review, recalculation_deferred
+
+#Between full retrains only the reviewer's own latent vector is re-solved
+_retrain_lock = threading.Lock()
+_reviews_since_retrain = 0
+
+#The RatingsRefresh queued for the current transaction of this thread
+_pending_ratings = threading.local()
+
+
+class RatingsRefresh:
+    """
+    The movies whose reviews one transaction changed, refreshed once when it commits.
+    """
+
+    def __init__(self):
+        self.movie_ids = set()
+
+    def __call__(self):
+        if getattr(_pending_ratings, 'refresh', None) is self:
+            _pending_ratings.refresh = None
+        Movie.refresh_ratings(self.movie_ids)
+
+
+def refresh_ratings_on_commit(movie_ids):
+    """
+    Refreshes the rating stats of the movies when the current transaction commits, once for
+    every movie it touched (e.g. all the reviews of a deleted user), or at once outside one.
+    """
+    refresh = getattr(_pending_ratings, 'refresh', None)
+    #A refresh leaves the queue when it runs or its transaction (or savepoint) is rolled back
+    if refresh is None or not any(func is refresh for _, func, _ in transaction.get_connection().run_on_commit):
+        refresh = _pending_ratings.refresh = RatingsRefresh()
+        refresh.movie_ids.update(movie_ids)
+        transaction.on_commit(refresh)
+    else:
+        refresh.movie_ids.update(movie_ids)
+
+
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def update_movie_rating(sender, instance, **kwargs):
+    refresh_ratings_on_commit([instance.movie_id])
+
 
 @receiver(post_save, sender=Review)
 def trigger_recommendation_update(sender, instance, created, **kwargs):
+    global _reviews_since_retrain
+
+    #Bulk ingestion recalculates once when it ends
+    if recalculation_deferred():
+        note_deferred_review()
+        return
 
     if created:
         print("\n--- OBSERVER NOTIFIED: New review created. Executing Command. ---")
     else:
         print("\n--- OBSERVER NOTIFIED: Review updated. Executing Command. ---")
 
-    # The observer triggers the command
-    command = RecalculateRecommendationsCommand()
-    command.execute()
\ No newline at end of file
+    full_retrain_every = getattr(settings, 'RECOMMENDER_FULL_RETRAIN_EVERY', 50)
+
+    with _retrain_lock:
+        if _reviews_since_retrain < full_retrain_every:
+            # The observer triggers the cheap command, it fails if nothing was trained yet
+            if FoldInUserCommand(instance.user_id).execute():
+                _reviews_since_retrain += 1
+                return
+
+        # The full retrain is queued for the recalculation worker, so the request saving
+        # the review does not wait for it
+        job = request_recalculation(reason=f"review {instance.pk} by user {instance.user_id}")
+        print(f"Queued recalculation #{job.id} ({job.trigger_count} triggers).")
+        _reviews_since_retrain = 0
+
+    #Without a worker (or before the first retrain) nobody would get recommendations
+    run_unattended(job, first=RecommendationGeneration.current_token() is None)
@@ -0,0 +1,231 @@
+import mmap
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+
+from .model_store import atomic_write
+from .models import Movie, Recommendation, RecommendationGeneration
+
+#File layout, all little-endian:
+#  header   magic, format version, section count, generation id, generation revision,
+#           model version (-1 if none)
+#  table    one entry per section: name, byte offset, byte length, dtype, rows, columns
+#  sections the arrays, each starting at a multiple of SECTION_ALIGNMENT
+MAGIC = b'RECSNAP\0'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sIIqqq')
+SECTION = struct.Struct('<16sQQ8sQQ')
+SECTION_ALIGNMENT = 64
+
+#The recommendations of user_ids[i] are rows offsets[i]:offsets[i + 1] of record_movie_ids
+#and record_scores, best first
+
+
+def snapshot_path():
+    return str(getattr(settings, 'RECOMMENDER_SNAPSHOT_PATH',
+                       os.path.join(str(settings.RECOMMENDER_MODEL_DIR), 'recommendations.snapshot')))
+
+
+def _aligned(offset):
+    return (offset + SECTION_ALIGNMENT - 1) // SECTION_ALIGNMENT * SECTION_ALIGNMENT
+
+
+def write_snapshot(path, token, model_version, sections):
+    """
+    Writes {name: array} with the layout above, replacing the file atomically.
+    """
+    sections = {name: np.ascontiguousarray(array) for name, array in sections.items()}
+    offset = _aligned(HEADER.size + SECTION.size * len(sections))
+
+    table = []
+    for name, array in sections.items():
+        rows = array.shape[0] if array.ndim else 1
+        columns = array.shape[1] if array.ndim > 1 else 0
+        table.append((name, offset, array.nbytes, array.dtype, rows, columns))
+        offset = _aligned(offset + array.nbytes)
+
+    os.makedirs(os.path.dirname(str(path)) or '.', exist_ok=True)
+    with atomic_write(path, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(table), token[0], token[1],
+                               -1 if model_version is None else model_version))
+        for name, section_offset, length, dtype, rows, columns in table:
+            file.write(SECTION.pack(name.encode(), section_offset, length, dtype.str.encode(), rows, columns))
+        for (name, section_offset, _, _, _, _), array in zip(table, sections.values()):
+            file.write(b'\0' * (section_offset - file.tell()))
+            file.write(array.tobytes())
+        #Empty trailing sections still lie within the file
+        file.write(b'\0' * (offset - file.tell()))
+
+
+def export_snapshot(path=None, model=None):
+    """
+    Writes the recommendations of the current generation, the names of the recommended
+    movies and, when a model is given, its factors. Returns the generation's (id, revision),
+    or None when nothing was published yet.
+    """
+    generation = RecommendationGeneration.current()
+    if generation is None:
+        return None
+
+    rows = (Recommendation.objects.filter(generation=generation)
+            .order_by('user_id', '-predicted_rating', 'movie_id')
+            .values_list('user_id', 'movie_id', 'predicted_rating'))
+    user_of_row, movie_of_row, scores = [], [], []
+    for user_id, movie_id, score in rows.iterator(chunk_size=10000):
+        user_of_row.append(user_id)
+        movie_of_row.append(movie_id)
+        scores.append(float(score))
+
+    user_of_row = np.array(user_of_row, dtype=np.int64)
+    user_ids, first_rows = np.unique(user_of_row, return_index=True)
+    offsets = np.append(first_rows, len(user_of_row)).astype(np.int64)
+
+    sections = {
+        'user_ids': user_ids,
+        'offsets': offsets,
+        'record_movie_ids': np.array(movie_of_row, dtype=np.int64),
+        'record_scores': np.array(scores, dtype=np.float64),
+    }
+
+    #Movie names as one UTF-8 blob: the name of name_movie_ids[i] is names[name_offsets[i]:name_offsets[i + 1]]
+    movie_ids = np.unique(sections['record_movie_ids'])
+    names = dict(Movie.objects.filter(id__in=movie_ids.tolist()).values_list('id', 'name'))
+    encoded = [names.get(int(m_id), '').encode() for m_id in movie_ids]
+    sections['name_movie_ids'] = movie_ids
+    sections['name_offsets'] = np.concatenate([[0], np.cumsum([len(name) for name in encoded])]).astype(np.int64)
+    sections['names'] = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+    if model is not None:
+        sections['factor_user_ids'] = np.asarray(model.user_ids, dtype=np.int64)
+        sections['factor_movie_ids'] = np.asarray(model.movie_ids, dtype=np.int64)
+        sections['U'] = np.asarray(model.U, dtype=np.float64)
+        sections['V'] = np.asarray(model.V, dtype=np.float64)
+
+    token = (generation.id, generation.revision)
+    write_snapshot(path or snapshot_path(), token, generation.model_version, sections)
+    return token
+
+
+class RecommendationSnapshot:
+    """
+    Read-only view of a snapshot file. The file is memory-mapped and every section is a NumPy
+    array over the mapping, so processes reading the same file share one copy in the page
+    cache and nothing is parsed or copied up front.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            self.stat = os.fstat(file.fileno())
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, count, generation_id, revision, model_version = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"{path} is not a version {FORMAT_VERSION} recommendation snapshot")
+        self.token = (generation_id, revision)
+        self.model_version = None if model_version < 0 else model_version
+
+        self.sections = {}
+        for i in range(count):
+            name, offset, length, dtype, rows, columns = SECTION.unpack_from(self._map, HEADER.size + i * SECTION.size)
+            dtype = np.dtype(dtype.rstrip(b'\0').decode())
+            shape = (rows, columns) if columns else (rows,)
+            self.sections[name.rstrip(b'\0').decode()] = np.frombuffer(
+                self._map, dtype=dtype, count=length // dtype.itemsize, offset=offset).reshape(shape)
+
+    def __getitem__(self, name):
+        return self.sections[name]
+
+    def name(self, movie_id):
+        movie_ids = self.sections['name_movie_ids']
+        i = np.searchsorted(movie_ids, movie_id)
+        if i == len(movie_ids) or movie_ids[i] != movie_id:
+            return ''
+        offsets = self.sections['name_offsets']
+        return self.sections['names'][offsets[i]:offsets[i + 1]].tobytes().decode()
+
+    def recommendations(self, user_id):
+        """
+        ((movie_id, name, score), ...) of the user, best first.
+        """
+        user_ids = self.sections['user_ids']
+        i = np.searchsorted(user_ids, user_id)
+        if i == len(user_ids) or user_ids[i] != user_id:
+            return ()
+        start, stop = self.sections['offsets'][i:i + 2]
+        movie_ids = self.sections['record_movie_ids'][start:stop]
+        scores = self.sections['record_scores'][start:stop]
+        return tuple((int(movie_id), self.name(movie_id), float(score)) for movie_id, score in zip(movie_ids, scores))
+
+    def factors(self):
+        """
+        (user_ids, U, movie_ids, V) if the snapshot was exported with a model, else None.
+        """
+        if 'U' not in self.sections:
+            return None
+        return (self.sections['factor_user_ids'], self.sections['U'],
+                self.sections['factor_movie_ids'], self.sections['V'])
+
+
+class SharedSnapshot:
+    """
+    The newest snapshot at a path. The file is checked at most every poll_interval seconds;
+    when it was replaced the new one is mapped and swapped in, and the old mapping is released
+    once no caller holds it anymore.
+    """
+
+    def __init__(self, path=None, poll_interval=None):
+        self.path = path or snapshot_path()
+        if poll_interval is None:
+            poll_interval = getattr(settings, 'RECOMMENDER_CACHE_POLL_INTERVAL', 2.0)
+        self.poll_interval = poll_interval
+        self.snapshot = None
+        self._checked_at = None
+        #((snapshot token, current token), users changed in between) of the last serving() call
+        self._changed = None
+        self._lock = threading.Lock()
+
+    def current(self):
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.poll_interval:
+            return self.snapshot
+
+        with self._lock:
+            self._checked_at = now
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                self.snapshot = None
+                return None
+
+            loaded = self.snapshot
+            if loaded is None or (stat.st_ino, stat.st_mtime_ns) != (loaded.stat.st_ino, loaded.stat.st_mtime_ns):
+                try:
+                    self.snapshot = RecommendationSnapshot(self.path)
+                    print(f"Mapped recommendation snapshot of generation {self.snapshot.token[0]}.")
+                except (OSError, ValueError) as e:
+                    print(f"Could not map {self.path}: {e}")
+            return self.snapshot
+
+    def serving(self, token):
+        """
+        (snapshot, changed user ids) if the snapshot was exported from the generation of token
+        (id, revision), at that revision or an earlier one; the snapshot's rows of the changed
+        users were replaced by fold-ins since. (None, frozenset()) if it cannot be used.
+        """
+        snapshot = self.current()
+        if snapshot is None or token is None or snapshot.token[0] != token[0] or snapshot.token[1] > token[1]:
+            return None, frozenset()
+        if snapshot.token[1] == token[1]:
+            return snapshot, frozenset()
+
+        key = (snapshot.token, tuple(token))
+        changed = self._changed
+        if changed is None or changed[0] != key:
+            users = RecommendationGeneration.changed_users(token[0], snapshot.token[1], token[1])
+            changed = self._changed = (key, frozenset(users))
+        return snapshot, changed[1]
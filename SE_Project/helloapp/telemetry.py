@@ -0,0 +1,131 @@
+import json
+import os
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.utils import timezone
+
+_write_lock = threading.Lock()
+
+
+def telemetry_path():
+    return str(getattr(settings, 'RECOMMENDER_TELEMETRY_PATH',
+                       os.path.join(str(settings.RECOMMENDER_MODEL_DIR), 'training_runs.jsonl')))
+
+
+class TrainingRun:
+    """
+    Collects the telemetry of one retrain and appends it as one JSON line when the run ends:
+    phase timings, the loss per evaluated epoch, peak traced memory and row counts.
+
+        with TrainingRun('retrain') as run:
+            with run.phase('load'):
+                ...
+            run.count('reviews', n)
+    """
+
+    def __init__(self, kind, path=None, trace_memory=None):
+        self.path = path or telemetry_path()
+        if trace_memory is None:
+            trace_memory = getattr(settings, 'RECOMMENDER_TELEMETRY_TRACE_MEMORY', True)
+        self.trace_memory = trace_memory
+        self._started_tracing = False
+        self._started = None
+        self.record = {
+            'run_id': uuid.uuid4().hex,
+            'kind': kind,
+            'started_at': None,
+            'status': 'running',
+            'seconds': None,
+            'phases': {},
+            'counts': {},
+            'loss': [],
+            'peak_memory_bytes': None,
+        }
+
+    def __enter__(self):
+        self.record['started_at'] = timezone.now().isoformat()
+        self._started = time.perf_counter()
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+            tracemalloc.reset_peak()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.record['seconds'] = time.perf_counter() - self._started
+        if exc_type is None:
+            self.record['status'] = 'ok'
+        else:
+            self.record['status'] = 'failed'
+            self.record['error'] = f"{exc_type.__name__}: {exc}"
+
+        if self.trace_memory:
+            self.record['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+            if self._started_tracing:
+                tracemalloc.stop()
+
+        self.write()
+        return False
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Times a block. Entering the same phase again adds to its total.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record['phases'][name] = self.record['phases'].get(name, 0.0) + time.perf_counter() - started
+
+    def timed(self, iterable, name):
+        """
+        Yields from iterable, adding the time spent producing each item to the phase.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, name, value=1):
+        self.record['counts'][name] = self.record['counts'].get(name, 0) + int(value)
+
+    def set(self, name, value):
+        self.record[name] = value
+
+    def write(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        line = json.dumps(self.record, default=str)
+        with _write_lock:
+            with open(self.path, 'a') as log:
+                log.write(line + '\n')
+
+
+def recent_runs(n=10, path=None, kind=None):
+    """
+    The last n telemetry records, oldest first, optionally only those of one kind.
+    """
+    runs = deque(maxlen=n)
+    try:
+        with open(path or telemetry_path()) as log:
+            for line in log:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if kind is None or record.get('kind') == kind:
+                    runs.append(record)
+    except FileNotFoundError:
+        pass
+    return list(runs)
@@ -1,3 +1,653 @@
-from django.test import TestCase
+import os
+import socket
+import tempfile
+import time
+from unittest import mock
+from datetime import date, timedelta
+
+import numpy as np
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from .commands import FoldInUserCommand, publish_generation
+from .factorization import EarlyStopping, RatingsData, Solver, TrainedModel, fold_in, top_n_per_user
+from .ingestion import BulkReviewIngestion
+from .jobs import BackgroundRecalculations, RecalculationWorker, unattended
+from .models import (GenerationChange, Genre, Movie, Profile, RecalculationJob, Recommendation, RecommendationGeneration,
+                     Review)
+from .pagination import keyset_page
+from .patterns import RecommendationEngine
+from .rpc_client import RecommendationClient, RecommendationServiceUnavailable, recommendations_for
+from .serving import RecommendationCache, ServedModel, stored_recommendations_many
+from .snapshot import RecommendationSnapshot, export_snapshot, write_snapshot
 
 # Create your tests here.
+
+
+class ScriptedSolver(Solver):
+    """
+    Solver whose epoch k sets the single user factor to values[k - 1], so the holdout RMSE
+    of every epoch is known in advance.
+    """
+
+    def __init__(self, values, early_stopping=None):
+        super().__init__(len(values), early_stopping)
+        self.values = values
+
+    def step(self, data, U, V):
+        return np.array([[self.values[self.epochs_run]]]), V
+
+
+def make_movies(count, **fields):
+    return [Movie.objects.create(name=f"Movie {i}", releaseDate=date(2000, 1, 1), director='', studio='', **fields)
+            for i in range(count)]
+
+
+def one_rating(rating=1.0):
+    return RatingsData([1], [1], [0], [0], [rating])
+
+
+class SolverFitTests(SimpleTestCase):
+    def fit(self, values, early_stopping, holdout=True):
+        solver = ScriptedSolver(values, early_stopping)
+        data = one_rating()
+        U, V = solver.fit(data, np.zeros((1, 1)), np.ones((1, 1)), holdout=one_rating() if holdout else None)
+        return solver, float(U[0, 0])
+
+    def test_stops_after_patience_stale_evaluations(self):
+        #Holdout RMSE per epoch: 1.0, 0.5, 0.1, 0.4, 0.7, 0.9, ...
+        solver, _ = self.fit([0.0, 0.5, 0.9, 0.6, 0.3, 0.1, 0.0, 0.0], EarlyStopping(patience=2))
+        self.assertEqual(solver.epochs_run, 5)
+        self.assertEqual([epoch for epoch, _ in solver.history], [1, 2, 3, 4, 5])
+
+    def test_returns_the_best_holdout_factors(self):
+        _, u = self.fit([0.0, 0.5, 0.9, 0.6, 0.3, 0.1, 0.0, 0.0], EarlyStopping(patience=2))
+        self.assertEqual(u, 0.9)
+
+    def test_last_epoch_is_evaluated_when_eval_every_skips_it(self):
+        #No epoch is due before the end, the trained factors must still be returned
+        solver, u = self.fit([0.2, 0.4, 0.6, 0.8, 0.9], EarlyStopping(eval_every=10))
+        self.assertEqual([epoch for epoch, _ in solver.history], [5])
+        self.assertEqual(u, 0.9)
+
+    def test_without_holdout_returns_the_last_factors(self):
+        _, u = self.fit([0.0, 0.5, 0.9, 0.6, 0.3, 0.1, 0.0, 0.0], EarlyStopping(patience=2), holdout=False)
+        self.assertEqual(u, 0.3)
+
+
+class TopNPerUserTests(SimpleTestCase):
+    def test_blocks_match_a_full_sort(self):
+        rng = np.random.default_rng(7)
+        num_users, num_items, n = 23, 40, 6
+        U, V = rng.normal(size=(num_users, 4)), rng.normal(size=(num_items, 4))
+
+        #Each user rated a random set of movies, one of them almost all
+        rated = [rng.choice(num_items, size=rng.integers(0, 10), replace=False) for _ in range(num_users)]
+        rated[3] = np.arange(num_items - 2)
+        user_idx = np.concatenate([[u_idx] * len(items) for u_idx, items in enumerate(rated)])
+        item_idx = np.concatenate(rated)
+        data = RatingsData(np.arange(num_users), np.arange(num_items), user_idx, item_idx, np.ones(len(item_idx)))
+
+        expected = U @ V.T
+        for u_idx, items in enumerate(rated):
+            expected[u_idx, items] = -np.inf
+        expected_items = np.argsort(-expected, axis=1, kind='stable')[:, :n]
+
+        for block_size in (1, 5, 64, None):
+            items = np.empty((num_users, n), dtype=np.int64)
+            scores = np.empty((num_users, n))
+            for start, block_items, block_scores in top_n_per_user(U, V, data, n, block_size=block_size):
+                items[start:start + len(block_items)] = block_items
+                scores[start:start + len(block_scores)] = block_scores
+
+            #Products of a row block can differ from the full product in the last bit
+            np.testing.assert_allclose(scores, np.take_along_axis(expected, expected_items, axis=1), rtol=1e-12)
+            #Leftover slots of the user with only two unrated movies hold -inf, in any order
+            finite = np.isfinite(scores)
+            np.testing.assert_array_equal(items[finite], expected_items[finite])
+
+
+class KeysetPageTests(TestCase):
+    def setUp(self):
+        #Few distinct values, so most rows tie on the sort field and only the id orders them
+        for i in range(17):
+            Movie.objects.create(name=f"Movie {i % 3}", releaseDate=date(2000 + i % 2, 1, 1),
+                                 director='', studio='', rating_avg=float(i % 4))
+
+    def walk(self, field, descending, size):
+        rows, cursor, pages = [], None, 0
+        while True:
+            page, cursor = keyset_page(Movie.objects.all(), field, descending=descending, cursor=cursor, size=size)
+            rows.extend(movie.id for movie in page)
+            pages += 1
+            if cursor is None:
+                return rows, pages
+
+    def test_walks_every_row_once_in_order(self):
+        for field, descending in (('name', False), ('releaseDate', True), ('rating_avg', True)):
+            for size in (1, 4, 17, 50):
+                with self.subTest(field=field, size=size):
+                    order = (f'-{field}', '-id') if descending else (field, 'id')
+                    expected = list(Movie.objects.order_by(*order).values_list('id', flat=True))
+                    rows, pages = self.walk(field, descending, size)
+                    self.assertEqual(rows, expected)
+                    self.assertEqual(pages, max(1, -(-len(expected) // size)))
+
+    def test_invalid_cursor_starts_over(self):
+        first, _ = keyset_page(Movie.objects.all(), 'name', size=5)
+        page, _ = keyset_page(Movie.objects.all(), 'name', cursor='not a cursor', size=5)
+        self.assertEqual(page, first)
+
+
+class SnapshotTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'recommendations.snapshot')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_sections_round_trip(self):
+        sections = {
+            'ids': np.array([3, 1, 2], dtype=np.int64),
+            'factors': np.arange(12, dtype=np.float64).reshape(4, 3),
+            'blob': np.frombuffer('héllo'.encode(), dtype=np.uint8),
+            'empty': np.empty(0, dtype=np.int64),
+        }
+        write_snapshot(self.path, (7, 2), None, sections)
+
+        snapshot = RecommendationSnapshot(self.path)
+        self.assertEqual(snapshot.token, (7, 2))
+        self.assertIsNone(snapshot.model_version)
+        self.assertEqual(set(snapshot.sections), set(sections))
+        for name, array in sections.items():
+            self.assertEqual(snapshot[name].dtype, array.dtype)
+            np.testing.assert_array_equal(snapshot[name], array)
+
+    def test_export_matches_the_stored_recommendations(self):
+        users = [User.objects.create(username=f"user{i}") for i in range(3)]
+        movies = [Movie.objects.create(name=f"Movie {i}", releaseDate=date(2000, 1, 1), director='', studio='')
+                  for i in range(4)]
+        generation = RecommendationGeneration.objects.create(model_version=3)
+        generation.publish()
+        for user, scores in zip(users, ([4.5, 9.25, 7.0], [1.0], [])):
+            Recommendation.objects.bulk_create([
+                Recommendation(generation=generation, user=user, movie=movie, predicted_rating=score)
+                for movie, score in zip(movies, scores)
+            ])
+
+        token = export_snapshot(self.path)
+        snapshot = RecommendationSnapshot(self.path)
+        self.assertEqual(snapshot.token, token)
+        self.assertEqual(snapshot.model_version, 3)
+        self.assertEqual(snapshot.recommendations(users[0].id), (
+            (movies[1].id, 'Movie 1', 9.25), (movies[2].id, 'Movie 2', 7.0), (movies[0].id, 'Movie 0', 4.5)))
+        self.assertEqual(snapshot.recommendations(users[1].id), ((movies[0].id, 'Movie 0', 1.0),))
+        self.assertEqual(snapshot.recommendations(users[2].id), ())
+        self.assertIsNone(snapshot.factors())
+
+
+class PublishGenerationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='reader')
+        self.movies = make_movies(2)
+        with publish_generation(model_version=1) as generation:
+            Recommendation.objects.create(generation=generation, user=self.user, movie=self.movies[0],
+                                          predicted_rating=5)
+        self.old = generation
+
+    def current_movies(self):
+        return list(Recommendation.objects.current().values_list('movie_id', flat=True))
+
+    def test_new_rows_are_hidden_until_the_generation_is_published(self):
+        with publish_generation(model_version=2) as generation:
+            Recommendation.objects.create(generation=generation, user=self.user, movie=self.movies[1],
+                                          predicted_rating=6)
+            self.assertEqual(self.current_movies(), [self.movies[0].id])
+            self.assertEqual(RecommendationGeneration.current(), self.old)
+
+        self.assertEqual(self.current_movies(), [self.movies[1].id])
+        self.assertEqual(RecommendationGeneration.current(), generation)
+        #The replaced generation is deleted with its rows
+        self.assertFalse(RecommendationGeneration.objects.filter(pk=self.old.pk).exists())
+        self.assertEqual(Recommendation.objects.count(), 1)
+
+    def test_failed_block_keeps_the_current_generation(self):
+        with self.assertRaises(RuntimeError):
+            with publish_generation(model_version=2) as generation:
+                Recommendation.objects.create(generation=generation, user=self.user, movie=self.movies[1],
+                                              predicted_rating=6)
+                raise RuntimeError("scoring failed")
+
+        self.assertEqual(RecommendationGeneration.current(), self.old)
+        self.assertEqual(self.current_movies(), [self.movies[0].id])
+        self.assertFalse(RecommendationGeneration.objects.filter(pk=generation.pk).exists())
+
+    def test_publishing_deletes_only_older_generations(self):
+        #Left unpublished by a retrain that died, and started by another one meanwhile
+        abandoned = RecommendationGeneration.objects.create(model_version=2)
+        with publish_generation(model_version=3) as generation:
+            newer = RecommendationGeneration.objects.create(model_version=4)
+
+        self.assertEqual(set(RecommendationGeneration.objects.values_list('id', flat=True)),
+                         {generation.id, newer.id})
+        self.assertLess(abandoned.id, generation.id)
+
+
+class FoldInTests(TestCase):
+    def setUp(self):
+        self.users = [User.objects.create(username=f"user{i}") for i in range(2)]
+        self.movies = make_movies(4)
+        #Two factors; the third movie scores twice the first, so scores go past the rating scale
+        V = np.array([[1.0, 0.0], [0.0, 1.0], [2.0, 0.0], [0.5, 0.5]])
+        self.model = TrainedModel(np.zeros((0, 2)), V, [], [movie.id for movie in self.movies],
+                                  hyper_parameters={'reg': 0.1, 'top_n': 2})
+        with publish_generation() as generation:
+            Recommendation.objects.create(generation=generation, user=self.users[1], movie=self.movies[0],
+                                          predicted_rating=4)
+        self.generation = generation
+
+    def stored(self, user):
+        return list(Recommendation.objects.current().filter(user=user)
+                    .order_by('-predicted_rating').values_list('movie_id', 'predicted_rating'))
+
+    def test_replaces_only_the_users_rows_with_unclipped_scores(self):
+        Review.objects.bulk_create([Review(user=self.users[0], movie=self.movies[0], rating=9, text='')])
+        other_before = self.stored(self.users[1])
+
+        self.assertTrue(FoldInUserCommand(self.users[0].id, model=self.model).execute())
+
+        scores = self.model.V @ fold_in(self.model.V, [0], [9.0], 0.1)
+        stored = self.stored(self.users[0])
+        self.assertEqual([movie_id for movie_id, _ in stored], [self.movies[2].id, self.movies[3].id])
+        self.assertAlmostEqual(float(stored[0][1]), scores[2], places=2)
+        self.assertGreater(float(stored[0][1]), 10)
+        self.assertEqual(self.stored(self.users[1]), other_before)
+
+    def test_records_the_changed_user_in_a_new_revision(self):
+        Review.objects.bulk_create([Review(user=self.users[0], movie=self.movies[1], rating=6, text='')])
+        before = RecommendationGeneration.current_token()
+
+        FoldInUserCommand(self.users[0].id, model=self.model).execute()
+
+        self.assertEqual(RecommendationGeneration.current_token(), (before[0], before[1] + 1))
+        self.assertEqual(RecommendationGeneration.changed_users(before[0], before[1]), {self.users[0].id})
+        self.assertEqual(RecommendationGeneration.changed_users(before[0], before[1] + 1), set())
+
+    def test_bump_revision_without_users_records_no_change(self):
+        self.generation.bump_revision()
+        self.generation.bump_revision([self.users[1].id])
+        self.assertEqual(self.generation.revision, 2)
+        self.assertEqual(list(GenerationChange.objects.values_list('revision', 'user_id')), [(2, self.users[1].id)])
+        self.assertEqual(RecommendationGeneration.changed_users(self.generation.id, 0, 1), set())
+
+    def test_nothing_is_written_without_reviews_or_a_generation(self):
+        self.assertFalse(FoldInUserCommand(self.users[0].id, model=self.model).execute())
+
+        Review.objects.bulk_create([Review(user=self.users[0], movie=self.movies[0], rating=9, text='')])
+        RecommendationGeneration.objects.update(is_current=False)
+        self.assertFalse(FoldInUserCommand(self.users[0].id, model=self.model).execute())
+        self.assertFalse(Recommendation.objects.filter(user=self.users[0]).exists())
+
+
+class ServedModelTests(TestCase):
+    def test_known_user_is_folded_in_from_current_reviews(self):
+        user = User.objects.create(username='user')
+        movies = make_movies(3)
+        V = np.array([[1.0, 0.0], [0.0, 1.0], [1.0, 1.0]])
+        #The trained row predates the user's reviews
+        model = TrainedModel(np.array([[5.0, 5.0]]), V, [user.id], [movie.id for movie in movies],
+                             hyper_parameters={'reg': 0.1})
+        Review.objects.bulk_create([Review(user=user, movie=movies[1], rating=8, text='')])
+
+        rated_idx, ratings = ServedModel.reviewed(model, user.id)
+        self.assertEqual(list(rated_idx), [1])
+        np.testing.assert_allclose(ServedModel.user_vector(model, rated_idx, ratings), fold_in(V, [1], [8.0], 0.1))
+        self.assertIsNone(ServedModel.user_vector(model, *ServedModel.reviewed(model, user.id + 1)))
+
+
+class RecalculationQueueTests(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+        self.worker = RecalculationWorker(debounce=5, min_interval=60, max_delay=300)
+
+    def pending(self, requested_ago, triggered_ago):
+        job = RecalculationJob.enqueue('test')
+        RecalculationJob.objects.filter(pk=job.pk).update(
+            requested_at=self.now - timedelta(seconds=requested_ago),
+            last_triggered_at=self.now - timedelta(seconds=triggered_ago))
+        return job
+
+    def test_waits_for_the_debounce(self):
+        job = self.pending(requested_ago=10, triggered_ago=2)
+        self.assertIsNone(self.worker.due_job(self.now))
+        self.assertEqual(self.worker.due_job(self.now + timedelta(seconds=4)), job)
+
+    def test_max_delay_overrides_the_debounce(self):
+        job = self.pending(requested_ago=301, triggered_ago=1)
+        self.assertEqual(self.worker.due_job(self.now), job)
+
+    def test_waits_min_interval_after_the_last_retrain(self):
+        RecalculationJob.objects.create(status=RecalculationJob.DONE, finished_at=self.now - timedelta(seconds=30))
+        job = self.pending(requested_ago=20, triggered_ago=20)
+        self.assertIsNone(self.worker.due_job(self.now))
+        self.assertEqual(self.worker.due_job(self.now + timedelta(seconds=31)), job)
+
+    def test_triggers_merge_into_the_pending_job(self):
+        first = RecalculationJob.enqueue('a')
+        second = RecalculationJob.enqueue('b')
+        self.assertEqual(first.id, second.id)
+        self.assertEqual(second.trigger_count, 2)
+
+    def test_waits_for_a_running_job(self):
+        running = RecalculationJob.enqueue('running')
+        self.assertTrue(running.claim())
+        self.pending(requested_ago=20, triggered_ago=20)
+        self.assertIsNone(self.worker.due_job(self.now))
+
+    def test_silent_running_job_is_failed_and_queued_again(self):
+        job = RecalculationJob.enqueue('crashed')
+        job.claim()
+        RecalculationJob.objects.filter(pk=job.pk).update(heartbeat_at=self.now - timedelta(seconds=600))
+
+        due = self.worker.due_job(self.now)
+        job.refresh_from_db()
+        self.assertEqual(job.status, RecalculationJob.FAILED)
+        self.assertIn('No heartbeat', job.error)
+        #The failed job counts as the last retrain, its retry waits min_interval
+        self.assertIsNone(due)
+        retry = RecalculationJob.objects.get(status=RecalculationJob.PENDING)
+        self.assertEqual(retry.reason, f"retry of #{job.id}: crashed")
+
+        #Checking again neither fails nor re-queues it twice
+        self.assertEqual(RecalculationJob.fail_stale(now=self.now), [])
+        self.assertEqual(RecalculationJob.objects.filter(status=RecalculationJob.PENDING).count(), 1)
+
+    def test_running_job_with_a_heartbeat_is_kept(self):
+        job = RecalculationJob.enqueue('alive')
+        job.claim()
+        job.beat()
+        self.assertEqual(RecalculationJob.fail_stale(), [])
+        self.assertEqual(RecalculationJob.in_flight(), job)
+
+    def test_unattended_only_without_a_running_retrain(self):
+        job = self.pending(requested_ago=700, triggered_ago=700)
+        job.refresh_from_db()
+        self.assertTrue(unattended(job, self.now))
+        self.assertFalse(unattended(job, self.now - timedelta(seconds=200)))
+
+        RecalculationJob.objects.create(status=RecalculationJob.RUNNING, heartbeat_at=self.now)
+        self.assertFalse(unattended(job, self.now))
+
+
+class BulkReviewIngestionTests(TestCase):
+    def setUp(self):
+        self.users = [User.objects.create(username=f"user{i}") for i in range(2)]
+        self.movies = make_movies(3)
+
+    def test_counts_saved_and_skipped_reviews(self):
+        Review.objects.bulk_create([Review(user=self.users[0], movie=self.movies[0], rating=5, text='')])
+
+        with BulkReviewIngestion(batch_size=2, retrain=None) as ingestion:
+            self.assertTrue(ingestion.add(self.users[0], self.movies[0], 9))
+            self.assertTrue(ingestion.add(self.users[0], self.movies[1], 8))
+            self.assertTrue(ingestion.add(self.users[1], self.movies[1], 6))
+            self.assertFalse(ingestion.add(self.users[1], self.movies[1], 7))
+
+        self.assertEqual((ingestion.created, ingestion.skipped), (2, 2))
+        self.assertEqual(Review.objects.count(), 3)
+        #The existing review is kept, not overwritten
+        self.assertEqual(Review.objects.get(user=self.users[0], movie=self.movies[0]).rating, 5)
+
+        self.movies[1].refresh_from_db()
+        self.assertEqual((self.movies[1].rating_avg, self.movies[1].rating_count), (7.0, 2))
+
+    def test_reviews_written_concurrently_are_not_counted(self):
+        bulk_create = Review.objects.bulk_create
+
+        def racing_bulk_create(reviews, **kwargs):
+            #Someone else reviews the first movie between the lookup and the insert
+            bulk_create([Review(user=self.users[0], movie=self.movies[0], rating=3, text='')])
+            return bulk_create(reviews, **kwargs)
+
+        with mock.patch.object(Review.objects, 'bulk_create', side_effect=racing_bulk_create):
+            with BulkReviewIngestion(retrain=None) as ingestion:
+                for movie in self.movies:
+                    ingestion.add(self.users[0], movie, 8)
+
+        self.assertEqual((ingestion.created, ingestion.skipped), (2, 1))
+        self.assertEqual(Review.objects.get(user=self.users[0], movie=self.movies[0]).rating, 3)
+
+    def test_queues_one_retrain_for_the_whole_block(self):
+        with BulkReviewIngestion(batch_size=1, retrain='queue') as ingestion:
+            for movie in self.movies:
+                ingestion.add(self.users[0], movie, 8)
+
+        job = RecalculationJob.objects.get()
+        self.assertEqual((job.trigger_count, job.reason), (1, "bulk ingestion of 3 reviews"))
+
+
+class RecommendationCacheTests(TestCase):
+    def setUp(self):
+        self.users = [User.objects.create(username=f"user{i}") for i in range(3)]
+        self.movies = make_movies(2)
+        self.generation = self.publish(self.movies[0])
+        self.cache = RecommendationCache(poll_interval=0)
+        self.loaded = []
+
+    def publish(self, movie):
+        with publish_generation() as generation:
+            for user in self.users:
+                Recommendation.objects.create(generation=generation, user=user, movie=movie, predicted_rating=5)
+        return generation
+
+    def load_many(self, user_ids):
+        self.loaded.extend(user_ids)
+        return stored_recommendations_many(user_ids)
+
+    def fill(self):
+        return self.cache.get_many([user.id for user in self.users], self.load_many)
+
+    def test_loads_only_the_missing_users(self):
+        self.cache.get_many([self.users[0].id], self.load_many)
+        recs = self.fill()
+
+        self.assertEqual(self.loaded, [self.users[0].id, self.users[1].id, self.users[2].id])
+        self.assertEqual(recs[self.users[2].id], ((self.movies[0].id, 'Movie 0', 5.0),))
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_fold_in_evicts_only_the_changed_user(self):
+        self.fill()
+        Recommendation.objects.filter(user=self.users[1]).update(movie=self.movies[1])
+        self.generation.bump_revision([self.users[1].id])
+
+        self.loaded = []
+        recs = self.fill()
+        self.assertEqual(self.loaded, [self.users[1].id])
+        self.assertEqual(recs[self.users[1].id][0][0], self.movies[1].id)
+        #Only the first check, which found no generation cached yet, dropped everything
+        self.assertEqual(self.cache.stats()['invalidations'], 1)
+        self.assertEqual(self.cache.stats()['user_invalidations'], 1)
+
+    def test_new_generation_drops_everything(self):
+        self.fill()
+        self.publish(self.movies[1])
+
+        self.loaded = []
+        recs = self.fill()
+        self.assertEqual(len(self.loaded), 3)
+        self.assertEqual({user_recs[0][0] for user_recs in recs.values()}, {self.movies[1].id})
+
+
+class BackgroundRecalculationsTests(TestCase):
+    def setUp(self):
+        self.finished = []
+        self.recalculations = BackgroundRecalculations(on_finished=self.finished.append)
+        self.recalculations._executor = mock.Mock()
+
+    def test_triggers_collapse_into_the_pending_job(self):
+        first = self.recalculations.trigger('a')
+        second = self.recalculations.trigger('b')
+
+        self.assertEqual(first.id, second.id)
+        self.assertEqual(RecalculationJob.objects.get().trigger_count, 2)
+
+    def test_running_job_is_returned_without_queueing_another(self):
+        running = RecalculationJob.enqueue('elsewhere')
+        running.claim()
+        running.beat()
+
+        self.assertEqual(self.recalculations.trigger('again'), running)
+        self.assertFalse(RecalculationJob.objects.filter(status=RecalculationJob.PENDING).exists())
+        self.recalculations._executor.submit.assert_not_called()
+
+    def test_enqueue_only_leaves_the_job_to_the_worker(self):
+        self.recalculations.enqueue_only = True
+        job = self.recalculations.trigger('forked')
+
+        self.assertEqual(job.status, RecalculationJob.PENDING)
+        self.recalculations._executor.submit.assert_not_called()
+
+    @mock.patch('helloapp.jobs.close_old_connections')
+    @mock.patch('helloapp.jobs.run_job')
+    def test_run_claims_and_runs_the_job_once(self, run_job, close_old_connections):
+        def finish(job):
+            self.assertEqual(job.status, RecalculationJob.RUNNING)
+            job.status = RecalculationJob.DONE
+            job.save(update_fields=['status'])
+        run_job.side_effect = finish
+
+        job = self.recalculations.trigger('now')
+        self.recalculations._executor.submit.assert_called_once_with(self.recalculations._run, job.id)
+
+        self.recalculations._run(job.id)
+        #A second run of the same job, e.g. by the worker, finds it claimed
+        self.recalculations._run(job.id)
+
+        run_job.assert_called_once()
+        self.assertEqual(len(self.finished), 1)
+
+
+def unused_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+class RecommendationClientTests(TestCase):
+    def setUp(self):
+        self.client = RecommendationClient(host='localhost', port=unused_port(), backoff=10, max_backoff=40)
+
+    def test_failure_backs_off_without_connecting_again(self):
+        with self.assertRaises(RecommendationServiceUnavailable):
+            self.client.call('get_recommendations_many', (1,))
+        self.assertFalse(self.client.available)
+
+        with mock.patch.object(self.client, '_connect') as connect:
+            with self.assertRaises(RecommendationServiceUnavailable):
+                self.client.call('get_recommendations_many', (1,))
+        connect.assert_not_called()
+
+    def test_backoff_doubles_up_to_the_maximum(self):
+        delays = []
+        for _ in range(4):
+            self.client._retry_at = 0.0
+            with self.assertRaises(RecommendationServiceUnavailable):
+                self.client.call('get_recommendations_many', (1,))
+            delays.append(round(self.client._retry_at - time.monotonic()))
+        self.assertEqual(delays, [10, 20, 40, 40])
+
+    def test_recommendations_fall_back_to_the_database(self):
+        user = User.objects.create(username='user')
+        movie = make_movies(1)[0]
+        with publish_generation() as generation:
+            Recommendation.objects.create(generation=generation, user=user, movie=movie, predicted_rating=4)
+        expected = ((movie.id, movie.name, 4.0),)
+
+        with mock.patch('helloapp.rpc_client.get_client', return_value=self.client):
+            self.assertEqual(recommendations_for(user.id), expected)
+            #Backing off now, the database answers at once
+            self.assertEqual(recommendations_for(user.id), expected)
+
+        #An error raised by the service itself falls back too
+        with mock.patch.object(self.client, 'call', side_effect=ValueError('database is locked\ntraceback')):
+            with mock.patch('helloapp.rpc_client.get_client', return_value=self.client):
+                self.assertEqual(recommendations_for(user.id), expected)
+
+
+class CheckMoviesTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='user')
+        today = date.today()
+        self.profile = Profile.objects.create(user=self.user, birthdate=date(today.year - 15, 1, 1))
+        self.horror = Genre.objects.create(name='Horror')
+        self.comedy = Genre.objects.create(name='Comedy')
+        self.movies = make_movies(20)
+        for i, movie in enumerate(self.movies):
+            movie.genres.add(self.horror if i % 2 else self.comedy)
+        Review.objects.bulk_create([Review(user=self.user, movie=self.movies[0], rating=3, text='')])
+
+    def check(self, movies):
+        return RecommendationEngine().check_movies(self.user, movies, self.profile)
+
+    def test_query_count_does_not_grow_with_the_page(self):
+        #The page itself, the user's reviews and the genres of the whole page
+        for size in (2, 20):
+            with self.assertNumQueries(3):
+                errors = self.check(Movie.objects.filter(id__in=[m.id for m in self.movies[:size]]))
+            self.assertEqual(len(errors), size)
+
+        #Genres prefetched by the caller are not loaded again
+        movies = list(Movie.objects.prefetch_related('genres'))
+        with self.assertNumQueries(1):
+            errors = self.check(movies)
+
+        self.assertEqual(len(errors[self.movies[0].id]), 1)
+        self.assertEqual(len(errors[self.movies[1].id]), 1)
+        self.assertEqual(errors[self.movies[2].id], [])
+
+
+class MovieRatingRefreshTests(TestCase):
+    def setUp(self):
+        self.movies = make_movies(60)
+
+    def user_with_reviews(self, name, count, rating=4):
+        user = User.objects.create(username=name)
+        Review.objects.bulk_create([Review(user=user, movie=movie, rating=rating, text='')
+                                    for movie in self.movies[:count]])
+        return user
+
+    def delete_queries(self, user):
+        with self.captureOnCommitCallbacks(execute=True):
+            with CaptureQueriesContext(connection) as queries:
+                user.delete()
+        return len(queries)
+
+    def test_deleting_a_user_refreshes_every_movie_once(self):
+        self.user_with_reviews('other', 60, rating=8)
+        Movie.refresh_ratings([movie.id for movie in self.movies])
+
+        few = self.delete_queries(self.user_with_reviews('few', 5))
+        many = self.delete_queries(self.user_with_reviews('many', 50))
+        self.assertEqual(few, many)
+
+        for movie in Movie.objects.all():
+            self.assertEqual((movie.rating_avg, movie.rating_count), (8.0, 1))
+
+    def test_rolled_back_savepoint_does_not_stop_later_refreshes(self):
+        user = self.user_with_reviews('user', 2)
+        Movie.refresh_ratings([movie.id for movie in self.movies[:2]])
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    Review.objects.get(user=user, movie=self.movies[0]).delete()
+                    raise ValueError
+            except ValueError:
+                pass
+            Review.objects.get(user=user, movie=self.movies[1]).delete()
+
+        self.assertEqual(Movie.objects.get(pk=self.movies[0].pk).rating_count, 1)
+        self.assertEqual(Movie.objects.get(pk=self.movies[1].pk).rating_count, 0)
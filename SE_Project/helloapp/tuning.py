@@ -0,0 +1,130 @@
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .factorization import build_solver, rmse, top_n_per_user
+
+#The ratings of the data set being tuned, set once per pool worker by _init_worker
+_worker_data = None
+
+
+def kfold_indices(num_ratings, folds, seed=None):
+    """
+    Assigns every rating to one of `folds` folds at random. Returns the fold number per rating.
+    """
+    rng = np.random.default_rng(seed)
+    return rng.permutation(num_ratings) % folds
+
+
+def precision_at_k(U, V, train, test, k, relevant_rating):
+    """
+    Mean share of each user's top-k recommendations (movies unrated in train) that the user
+    rated at least relevant_rating in test. Users without such a test rating are skipped.
+    """
+    relevant = test.ratings >= relevant_rating
+    if not relevant.any():
+        return 0.0
+
+    liked = set(zip(test.user_idx[relevant].tolist(), test.item_idx[relevant].tolist()))
+    users_with_likes = {u_idx for u_idx, _ in liked}
+
+    precisions = []
+    for first_u_idx, block_items, block_scores in top_n_per_user(U, V, train, k):
+        for row, (items, scores) in enumerate(zip(block_items, block_scores)):
+            u_idx = first_u_idx + row
+            if u_idx not in users_with_likes:
+                continue
+            hits = sum((u_idx, int(m_idx)) in liked for m_idx, score in zip(items, scores) if score != -np.inf)
+            precisions.append(hits / k)
+
+    return float(np.mean(precisions)) if precisions else 0.0
+
+
+def cross_validate(data, hyper_parameters, fold_of, top_k=5, relevant_rating=7.0):
+    """
+    Trains once per fold on the other folds and averages the RMSE and precision@k measured
+    on the held out fold. Also returns the wall-clock seconds the whole run took.
+    """
+    started = time.perf_counter()
+    folds = int(fold_of.max()) + 1
+    errors, precisions = [], []
+
+    for fold in range(folds):
+        train = data.subset(fold_of != fold)
+        test = data.subset(fold_of == fold)
+
+        rng = np.random.default_rng(hyper_parameters['seed'])
+        U = rng.random((data.num_users, hyper_parameters['factors']))
+        V = rng.random((data.num_items, hyper_parameters['factors']))
+        U, V = build_solver(hyper_parameters).fit(train, U, V)
+
+        errors.append(rmse(U, V, test))
+        precisions.append(precision_at_k(U, V, train, test, top_k, relevant_rating))
+
+    return {
+        'hyper_parameters': hyper_parameters,
+        'rmse': float(np.mean(errors)),
+        'precision_at_k': float(np.mean(precisions)),
+        'seconds': time.perf_counter() - started,
+    }
+
+
+def candidate_configs(base, grid, samples=None, seed=None):
+    """
+    Every combination of the values in `grid` ({name: [values]}) applied over `base`, or
+    `samples` of them drawn at random.
+    """
+    names = list(grid)
+    combinations = list(itertools.product(*(grid[name] for name in names)))
+    if samples is not None and samples < len(combinations):
+        combinations = random.Random(seed).sample(combinations, samples)
+    return [{**base, **dict(zip(names, values))} for values in combinations]
+
+
+def _init_worker(data):
+    global _worker_data
+    _worker_data = data
+
+
+def _cross_validate_in_worker(hyper_parameters, fold_of, top_k, relevant_rating):
+    return cross_validate(_worker_data, hyper_parameters, fold_of, top_k, relevant_rating)
+
+
+def search(data, configs, folds=5, workers=1, top_k=5, relevant_rating=7.0, seed=None):
+    """
+    Cross-validates every config on the same folds in a process pool. The ratings are sent
+    to each worker once. Yields the results as the configs finish, in config order.
+    """
+    fold_of = kfold_indices(data.num_ratings, folds, seed)
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker, initargs=(data,)) as pool:
+        futures = [
+            pool.submit(_cross_validate_in_worker, config, fold_of, top_k, relevant_rating)
+            for config in configs
+        ]
+        for future in futures:
+            yield future.result()
+
+
+def save_tuned_hyper_parameters(path, hyper_parameters, result=None):
+    os.makedirs(os.path.dirname(str(path)) or '.', exist_ok=True)
+    with open(path, 'w') as file:
+        json.dump({'hyper_parameters': hyper_parameters, 'result': result}, file, indent=2)
+
+
+def load_tuned_hyper_parameters(path):
+    """
+    The hyper_parameters written by the last tuning run, or {} if there was none.
+    """
+    try:
+        with open(path) as file:
+            return json.load(file)['hyper_parameters']
+    except (FileNotFoundError, KeyError, ValueError):
+        return {}
@@ -1,3 +1,5 @@
+from datetime import date
+
 from django.db.models import Avg
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import authenticate, login, logout
@@ -9,9 +11,12 @@ from django.core.mail import send_mail
 from django.urls import reverse
 from django.conf import settings
 
-from .models import Movie, Profile, Genre, LoginAttempt, Review, Recommendation
+from .models import Movie, Profile, Genre, LoginAttempt, Review, SimilarMovie
 from .handlers import AuthenticationHandler, EmailVerificationHandler, ReviewRateLimitingHandler
-from .patterns import RecommendationEngine
+from .patterns import AgeSafetyVisitor, RecommendationEngine, age_on
+from .cold_start import cold_start_recommendations
+from .pagination import keyset_page
+from .rpc_client import recommendations_for
 from .protocols import SessionProtocol, SessionState
 
 
@@ -27,6 +32,15 @@ def initialize_review_chain():
 
 REVIEW_CHAIN_START = initialize_review_chain()
 
+# Movie library: sort option -> (Movie field, descending), and page sizes
+LIBRARY_SORTS = {
+    'name': ('name', False),
+    'release': ('releaseDate', True),
+    'rating': ('rating_avg', True),
+}
+LIBRARY_PAGE_SIZE = 24
+LIBRARY_MAX_PAGE_SIZE = 100
+
 
 # --- AUTHENTICATION & REGISTRATION ---
 
@@ -189,28 +203,64 @@ def movie_library(request):
         return redirect("main")
 
     query = request.GET.get('search', '')
-
-    movies = Movie.objects.exclude(review__user=request.user).annotate(
-        avg_rating=Avg('review__rating')
-    )
-
-    if query:
-        movies = movies.filter(name__icontains=query)
+    sort = request.GET.get('sort', 'name')
+    if sort not in LIBRARY_SORTS:
+        sort = 'name'
+    genre_id = _int_or_none(request.GET.get('genre'))
+    year = _int_or_none(request.GET.get('year'))
+    per_page = min(max(_int_or_none(request.GET.get('per_page')) or LIBRARY_PAGE_SIZE, 1), LIBRARY_MAX_PAGE_SIZE)
 
     engine = RecommendationEngine()
     profile = request.user.profile
 
-    safe_movies = [
-        movie for movie in movies
-        if not engine.check_movie(request.user, movie, profile)
-    ]
+    # Filters run in the query, so a page costs the same however large the catalog is
+    movies = Movie.objects.exclude(review__user=request.user)
+
+    if query:
+        movies = movies.filter(name__icontains=query)
+    if genre_id is not None:
+        movies = movies.filter(genres__id=genre_id)
+    if year is not None and 1 <= year < 9999:
+        movies = movies.filter(releaseDate__gte=date(year, 1, 1), releaseDate__lt=date(year + 1, 1, 1))
+    if age_on(profile.birthdate, date.today()) < AgeSafetyVisitor.MINIMUM_AGE:
+        movies = movies.exclude(genres__name__in=AgeSafetyVisitor.RESTRICTED_GENRES)
+
+    field, descending = LIBRARY_SORTS[sort]
+    page, next_cursor = keyset_page(movies.prefetch_related('genres'), field, descending,
+                                    cursor=request.GET.get('cursor'), size=per_page)
+
+    errors = engine.check_movies(request.user, page, profile)
+    safe_movies = [movie for movie in page if not errors[movie.id]]
+
+    params = request.GET.copy()
+    params.pop('cursor', None)
+    first_page_query = params.urlencode()
+    next_page_query = None
+    if next_cursor is not None:
+        params['cursor'] = next_cursor
+        next_page_query = params.urlencode()
 
     return render(request, "mainpage/movie_library.html", {
         'movies': safe_movies,
-        'search_query': query
+        'search_query': query,
+        'sort': sort,
+        'genres': Genre.objects.order_by('name'),
+        'selected_genre': genre_id,
+        'year': year,
+        'per_page': per_page,
+        'is_first_page': not request.GET.get('cursor'),
+        'first_page_query': first_page_query,
+        'next_page_query': next_page_query,
     })
 
 
+def _int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
 # --- USER SOCIAL & REVIEWS ---
 
 @login_required
@@ -293,7 +343,15 @@ def movie_detail(request, movie_id):
 
     movie = get_object_or_404(Movie, id=movie_id)
     avg_rating = Review.objects.filter(movie=movie).aggregate(Avg('rating'))['rating__avg']
-    return render(request, "mainpage/movie_detail.html", {'movie': movie, 'avg_rating': avg_rating})
+
+    # Neighbours are precomputed by the retrain, never at request time
+    similar_movies = [
+        similar.neighbour for similar in
+        SimilarMovie.objects.current().filter(movie=movie).select_related('neighbour').order_by('rank')
+    ]
+    return render(request, "mainpage/movie_detail.html", {
+        'movie': movie, 'avg_rating': avg_rating, 'similar_movies': similar_movies
+    })
 
 
 @login_required
@@ -305,40 +363,46 @@ def recommendations(request):
     if request.method == "POST":
         selected_genres = request.POST.getlist('genres')
 
-        user_recs = Recommendation.objects.filter(user=request.user).order_by('-predicted_rating')
+        # Served by the recommendation service, or read from the database when it is down
+        user_recs = recommendations_for(request.user.id)
 
         safe_movies_data = []
         user_is_new = False
 
-        if not user_recs.exists():
+        if not user_recs:
             user_is_new = True
+
+            # New users get the precomputed popular picks of their genres and age band
+            profile = getattr(request.user, 'profile', None)
+            genre_ids = set(Genre.objects.filter(name__in=selected_genres).values_list('id', flat=True))
+            if profile is not None:
+                genre_ids.update(profile.genres.values_list('id', flat=True))
+
+            candidate_movies = cold_start_recommendations(request.user, profile, genre_ids)
         else:
-            target_movie_ids = [rec.movie_id for rec in user_recs]
+            movies = Movie.objects.in_bulk([movie_id for movie_id, _, _ in user_recs])
 
             candidate_movies = []
-            for m_id in target_movie_ids:
-                try:
-                    movie = Movie.objects.get(id=m_id)
-                    candidate_movies.append(movie)
-                except Movie.DoesNotExist:
-                    continue
-
-            for movie in candidate_movies:
-
-                avg_rating = Review.objects.filter(movie=movie).aggregate(Avg('rating'))['rating__avg']
-                if avg_rating is None:
-                    avg_rating = 0.0
-
-                genres_str = ", ".join([g.name for g in movie.genres.all()])
-
-                movie_data = {
-                    'title': movie.name,
-                    'year': movie.releaseDate.year,
-                    'rating': round(avg_rating, 1),
-                    'genres': genres_str,
-                    'predicted_score': next((r.predicted_rating for r in user_recs if r.movie_id == movie.id), 0)
-                }
-                safe_movies_data.append(movie_data)
+            for m_id, _, predicted_score in user_recs:
+                if m_id in movies:
+                    candidate_movies.append((movies[m_id], predicted_score))
+
+        for movie, predicted_score in candidate_movies:
+
+            avg_rating = Review.objects.filter(movie=movie).aggregate(Avg('rating'))['rating__avg']
+            if avg_rating is None:
+                avg_rating = 0.0
+
+            genres_str = ", ".join([g.name for g in movie.genres.all()])
+
+            movie_data = {
+                'title': movie.name,
+                'year': movie.releaseDate.year,
+                'rating': round(avg_rating, 1),
+                'genres': genres_str,
+                'predicted_score': predicted_score
+            }
+            safe_movies_data.append(movie_data)
 
         context = {
             'movies': safe_movies_data,
@@ -0,0 +1,178 @@
+import argparse
+import random
+import threading
+import time
+
+import rpyc
+
+#How each operation of the mix calls the service. Results are read completely, the way a
+#real caller would, so netref round-trips are part of the measured latency
+OPERATIONS = {
+    'get_recommendations': lambda root, user_ids: [(rec['id'], rec['score'])
+                                                   for rec in root.get_recommendations(user_ids[0])],
+    'get_recommendations_many': lambda root, user_ids: root.get_recommendations_many(tuple(user_ids)),
+    'recommend': lambda root, user_ids: root.recommend(user_ids[0], 10),
+    'trigger_recalculation': lambda root, user_ids: root.trigger_recalculation(),
+}
+
+
+def parse_mix(text):
+    """
+    "get_recommendations=0.9,trigger_recalculation=0.1" -> [(operation, weight), ...]
+    """
+    mix = []
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"Unknown operation: {name}")
+        mix.append((name, float(weight or 1)))
+    return mix
+
+
+def parse_user_ids(text):
+    """
+    "1-20" or "1,5,7" -> [user ids]
+    """
+    if '-' in text:
+        first, last = map(int, text.split('-'))
+        return list(range(first, last + 1))
+    return [int(user_id) for user_id in text.split(',')]
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))]
+
+
+class LoadClient(threading.Thread):
+    """
+    One simulated caller with its own connection, calling operations drawn from the mix
+    back to back until the deadline.
+    """
+
+    def __init__(self, host, port, mix, user_ids, batch_size, deadline, warmup_until, seed):
+        super().__init__(daemon=True)
+        self.host, self.port = host, port
+        self.mix = mix
+        self.user_ids = user_ids
+        self.batch_size = batch_size
+        self.deadline = deadline
+        self.warmup_until = warmup_until
+        self.random = random.Random(seed)
+        #{operation: [seconds per call]} and {operation: error count}, after the warmup
+        self.latencies = {name: [] for name, _ in mix}
+        self.errors = {name: 0 for name, _ in mix}
+        #Why the connection could not be opened, the client then makes no calls
+        self.connect_error = None
+
+    def run(self):
+        names = [name for name, _ in self.mix]
+        weights = [weight for _, weight in self.mix]
+        try:
+            conn = rpyc.connect(self.host, self.port, config={'sync_request_timeout': 60})
+        except Exception as e:
+            self.connect_error = f"{type(e).__name__}: {e}"
+            return
+        try:
+            while time.monotonic() < self.deadline:
+                name = self.random.choices(names, weights)[0]
+                user_ids = self.random.sample(self.user_ids, min(self.batch_size, len(self.user_ids)))
+
+                started = time.perf_counter()
+                try:
+                    OPERATIONS[name](conn.root, user_ids)
+                    failed = False
+                except Exception:
+                    failed = True
+                elapsed = time.perf_counter() - started
+
+                if time.monotonic() < self.warmup_until:
+                    continue
+                if failed:
+                    self.errors[name] += 1
+                else:
+                    self.latencies[name].append(elapsed)
+        finally:
+            conn.close()
+
+
+def run_load_test(host, port, clients, duration, mix, user_ids, batch_size=50, warmup=1.0, seed=0):
+    """
+    Runs `clients` concurrent callers for warmup + duration seconds.
+    Returns {operation: {calls, errors, throughput, p50, p95, p99, max}} with latencies in
+    milliseconds, plus an 'all' entry over every operation. Clients that could not connect
+    count as one error each in 'all'; RuntimeError is raised when none could.
+    """
+    started = time.monotonic()
+    warmup_until = started + warmup
+    deadline = warmup_until + duration
+
+    threads = [LoadClient(host, port, mix, user_ids, batch_size, deadline, warmup_until, seed + i)
+               for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    connect_errors = [thread.connect_error for thread in threads if thread.connect_error is not None]
+    if connect_errors:
+        print(f"{len(connect_errors)} of {clients} clients could not connect: {connect_errors[0]}")
+        if len(connect_errors) == clients:
+            raise RuntimeError(f"No client could connect to {host}:{port}: {connect_errors[0]}")
+
+    report = {}
+    names = [name for name, _ in mix] + ['all']
+    for name in names:
+        if name == 'all':
+            latencies = sorted(l for thread in threads for values in thread.latencies.values() for l in values)
+            errors = sum(sum(thread.errors.values()) for thread in threads) + len(connect_errors)
+        else:
+            latencies = sorted(l for thread in threads for l in thread.latencies[name])
+            errors = sum(thread.errors[name] for thread in threads)
+
+        report[name] = {
+            'calls': len(latencies),
+            'errors': errors,
+            'throughput': len(latencies) / duration,
+            'p50': percentile(latencies, 50) * 1000,
+            'p95': percentile(latencies, 95) * 1000,
+            'p99': percentile(latencies, 99) * 1000,
+            'max': (latencies[-1] if latencies else 0.0) * 1000,
+        }
+    return report
+
+
+def print_report(report, clients, duration):
+    print(f"\n{clients} clients for {duration:.0f}s")
+    print(f"{'operation':<26}{'calls':>8}{'errors':>8}{'calls/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for name, row in report.items():
+        print(f"{name:<26}{row['calls']:>8}{row['errors']:>8}{row['throughput']:>10.1f}"
+              f"{row['p50']:>9.2f}{row['p95']:>9.2f}{row['p99']:>9.2f}{row['max']:>9.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test for the recommendation RPyC service")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=18861)
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 8, 32],
+                        help="Concurrent clients; several values run one test each")
+    parser.add_argument('--duration', type=float, default=10.0, help="Measured seconds per test")
+    parser.add_argument('--warmup', type=float, default=1.0, help="Unmeasured seconds before each test")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('get_recommendations=0.99,trigger_recalculation=0.01'),
+                        help="Operations and their weights, e.g. get_recommendations=0.9,recommend=0.1")
+    parser.add_argument('--users', type=parse_user_ids, default=parse_user_ids('1-20'),
+                        help="User ids to ask for, as 1-20 or 1,5,7")
+    parser.add_argument('--batch-size', type=int, default=50, help="Users per get_recommendations_many call")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    for clients in args.clients:
+        report = run_load_test(args.host, args.port, clients, args.duration, args.mix, args.users,
+                               batch_size=args.batch_size, warmup=args.warmup, seed=args.seed)
+        print_report(report, clients, args.duration)
+
+
+if __name__ == "__main__":
+    main()
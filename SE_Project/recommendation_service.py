@@ -1,54 +1,189 @@
+import argparse
 import rpyc
 import os
 import django
-from rpyc.utils.server import ThreadedServer
+import numpy as np
+from rpyc.utils.server import ForkingServer, ThreadedServer, ThreadPoolServer
 
 # Setup Django Environment
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'SE_Project.settings')
 django.setup()
 
-from helloapp.models import Recommendation
-from helloapp.commands import RecalculateRecommendationsCommand
+from django.db import connections
+from helloapp.jobs import BackgroundRecalculations, job_status, wait_for_job
+from helloapp.serving import (RecommendationCache, ServedModel, pack_recommendations, stored_recommendations,
+                              stored_recommendations_many)
+from helloapp.snapshot import SharedSnapshot
+
+
+#Longest a single wait_job call blocks
+MAX_WAIT_SECONDS = 60
 
 
 class RecommendationService(rpyc.Service):
+    #One instance is created per connection, the loaded model and the cache are shared by all of them
+    served_model = ServedModel()
+    cache = RecommendationCache()
+    snapshot = SharedSnapshot()
+    recalculations = BackgroundRecalculations(on_finished=lambda job: RecommendationService.cache.invalidate())
+
     def on_connect(self, conn):
         print(f"Connected to {conn}")
 
     def on_disconnect(self, conn):
         print(f"Disconnected from {conn}")
 
-    def exposed_get_recommendations(self, user_id):
+    def current_snapshot(self):
         """
-        Retrieves recommendations from the database for the given user.
+        (snapshot, changed user ids) if the mapped snapshot was exported from the current
+        generation; the changed users were folded in since and are read from the database.
+        (None, frozenset()) if the snapshot cannot be used.
         """
-        print(f"Fetching recommendations for user_id: {user_id}")
+        self.cache.check_generation()
+        return self.snapshot.serving(self.cache.token)
 
-        recs = Recommendation.objects.filter(user_id=user_id).select_related('movie')
+    def exposed_get_recommendations(self, user_id):
+        """
+        Retrieves recommendations for the given user from the shared snapshot, or from the
+        cache when they were read from the database since the last recalculation or fold-in.
+        """
+        user_id = int(user_id)
+        snapshot, changed = self.current_snapshot()
+        if snapshot is not None and user_id not in changed:
+            recs = snapshot.recommendations(user_id)
+        else:
+            recs = self.cache.get(user_id, stored_recommendations)
 
         results = []
-        for rec in recs:
+        for movie_id, name, score in recs:
             results.append({
-                "id": rec.movie.id,
-                "name": rec.movie.name,
-                "score": float(rec.predicted_rating)
+                "id": movie_id,
+                "name": name,
+                "score": score
             })
-
-        print(f"Found {len(results)} recommendations.")
         return results
 
+    def exposed_get_cache_stats(self):
+        """
+        Size and hit/miss/eviction counters of the recommendation cache.
+        """
+        return tuple(self.cache.stats().items())
+
+    def exposed_get_recommendations_many(self, user_ids, packed=False):
+        """
+        Stored recommendations for many users in one round-trip, from the shared snapshot and
+        the cache like get_recommendations. Pass the ids as a tuple (or bytes of little-endian
+        int64) so they arrive by value, not as a remote list.
+
+        Returns ((user_id, ((movie_id, name, score), ...)), ...) with every requested user,
+        or with packed=True a bytes blob of (user_id, movie_id, score) records without the
+        names, for helloapp.serving.unpack_recommendations.
+        """
+        if isinstance(user_ids, bytes):
+            user_ids = np.frombuffer(user_ids, dtype='<i8').tolist()
+        else:
+            user_ids = [int(user_id) for user_id in user_ids]
+
+        snapshot, changed = self.current_snapshot()
+        if snapshot is not None:
+            recs = {user_id: snapshot.recommendations(user_id) for user_id in set(user_ids) - changed}
+            #Users folded in since the export are read like without a snapshot
+            from_database = changed.intersection(user_ids)
+        else:
+            recs, from_database = {}, set(user_ids)
+        recs.update(self.cache.get_many(sorted(from_database), stored_recommendations_many))
+
+        if packed:
+            return pack_recommendations([(user_id, movie_id, name, score) for user_id in sorted(recs)
+                                         for movie_id, name, score in recs[user_id]])
+        return tuple((user_id, tuple(recs[user_id])) for user_id in dict.fromkeys(user_ids))
+
+    def exposed_recommend(self, user_id, n=10, genres=(), exclude_reviewed=True, age_safe=True):
+        """
+        Scores the latest trained factors on request instead of reading the stored top 5:
+        any n, only movies of the given genres (ids or names, as a tuple), without the movies
+        the user reviewed and without movies the age safety rule blocks for them.
+        Returns ((movie_id, name, score), ...), best first.
+        """
+        return self.served_model.recommend(user_id, n, genres=tuple(genres),
+                                           exclude_reviewed=exclude_reviewed, age_safe=age_safe)
+
+    def exposed_get_top_k(self, user_id, k=10, nprobe=None, exact=False):
+        """
+        Scores the latest trained factors on demand through the ANN index: any k, and users
+        that joined after the last retrain are folded in from their reviews.
+        Returns ((movie_id, score), ...). exact=True compares against a brute-force scan.
+        """
+        return self.served_model.top_k(user_id, k, nprobe=nprobe, exact=exact)
+
     def exposed_trigger_recalculation(self):
         """
-        Triggers the Matrix Factorization algorithm to update recommendations.
+        Starts the Matrix Factorization algorithm to update recommendations in the background
+        and returns the job id at once. While a recalculation is already queued or running,
+        its id is returned instead of starting another one. The forking server only queues
+        the job, `manage.py recalculation_worker` has to run alongside it.
         """
-        print("Triggering recommendation recalculation...")
-        cmd = RecalculateRecommendationsCommand()
-        cmd.execute()
-        print("Recalculation complete.")
+        job = self.recalculations.trigger(reason="RPC trigger_recalculation")
+        print(f"Recalculation #{job.id} is {job.status}.")
+        return job.id
 
+    def exposed_get_job_status(self, job_id):
+        """
+        ((field, value), ...) with the status, phase, progress and timings of a recalculation,
+        or None for an unknown job id.
+        """
+        status = job_status(job_id)
+        return tuple(status.items()) if status is not None else None
 
-if __name__ == "__main__":
-    port = 18861
-    print(f"Starting Recommendation RPyC Service on port {port}...")
-    server = ThreadedServer(RecommendationService, port=port)
+    def exposed_wait_job(self, job_id, timeout=None):
+        """
+        Blocks until the recalculation is done or failed, or until timeout seconds (at most
+        MAX_WAIT_SECONDS) passed, and returns its status as get_job_status does. Call it again
+        to keep waiting; the caller's sync_request_timeout must exceed the wait.
+        """
+        #A client that gave up must not leave a server thread polling for good
+        timeout = MAX_WAIT_SECONDS if timeout is None else min(timeout, MAX_WAIT_SECONDS)
+        status = wait_for_job(job_id, timeout)
+        return tuple(status.items()) if status is not None else None
+
+#Selectable with --server: a thread per connection, a fixed pool of threads serving all
+#connections, or a forked process per connection
+SERVERS = {
+    'threaded': ThreadedServer,
+    'pool': ThreadPoolServer,
+    'forking': ForkingServer,
+}
+
+
+def build_server(kind='threaded', host=None, port=18861, threads=20):
+    options = {'hostname': host, 'port': port}
+    if kind == 'pool':
+        options['nbThreads'] = threads
+    if kind == 'forking':
+        #Children must not share the parent's database connection
+        connections.close_all()
+        #A child exits as soon as its client disconnects, killing a retrain running in it,
+        #so triggers are only queued for the recalculation worker
+        RecommendationService.recalculations.enqueue_only = True
+    return SERVERS[kind](RecommendationService, **options)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recommendation RPyC Service")
+    parser.add_argument('--server', choices=sorted(SERVERS), default='threaded',
+                        help="Server model (default: threaded)")
+    parser.add_argument('--host', default=None, help="Address to listen on (default: all)")
+    parser.add_argument('--port', type=int, default=18861)
+    parser.add_argument('--threads', type=int, default=20, help="Worker threads of the pool server")
+    args = parser.parse_args(argv)
+
+    print(f"Starting Recommendation RPyC Service ({args.server}) on port {args.port}...")
+    RecommendationService.served_model.refresh()
+    server = build_server(args.server, args.host, args.port, args.threads)
+    if RecommendationService.recalculations.enqueue_only:
+        print("Recalculations are queued for `manage.py recalculation_worker`.")
     server.start()
+
+
+if __name__ == "__main__":
+    main()
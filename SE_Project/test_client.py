@@ -1,16 +1,26 @@
 import rpyc
 import time
 
+#Seconds one wait_job call may block, the service caps it at 60
+WAIT_ROUND = 60
+
 
 def test_service():
     try:
         print("Connecting to RPyC Service...")
-        conn = rpyc.connect("localhost", 18861)
+        #wait_job blocks for up to WAIT_ROUND seconds, longer than rpyc's default 30s timeout
+        conn = rpyc.connect("localhost", 18861, config={'sync_request_timeout': WAIT_ROUND + 30})
         print("Connected.")
 
         print("Triggering recalculation...")
-        conn.root.trigger_recalculation()
-        print("Recalculation triggered.")
+        job_id = conn.root.trigger_recalculation()
+        print(f"Recalculation triggered (job {job_id}), waiting for it...")
+        deadline = time.monotonic() + 300
+        status = dict(conn.root.wait_job(job_id, WAIT_ROUND))
+        while status['status'] in ('pending', 'running') and time.monotonic() < deadline:
+            print(f"Recalculation is {status['status']} ({status['phase']}, {status['progress']:.0%})...")
+            status = dict(conn.root.wait_job(job_id, WAIT_ROUND))
+        print(f"Recalculation {status['status']} in {status['seconds']}s.")
 
         print("Fetching recommendations for User ID 1...")
         recs = conn.root.get_recommendations(1)